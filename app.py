@@ -1,15 +1,40 @@
+import copy
+import fcntl
+import hashlib
+import hmac
+import json
 import os
+import re
+import shlex
+import signal
 import subprocess
 import zipfile
 import tempfile
 import shutil
-from flask import Flask, request, send_file, jsonify
+import socket
+import sqlite3
+from flask import Flask, Response, request, send_file, jsonify, stream_with_context
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlparse
 
-app = Flask(__name__, static_folder='.', static_url_path='')
+try:
+    import yt_dlp
+    from yt_dlp.networking.common import DEFAULT_TIMEOUT as YT_DLP_SOCKET_TIMEOUT
+    from yt_dlp.networking.common import Request as YtDlpRequest
+    from yt_dlp.networking.impersonate import ImpersonateTarget
+    from yt_dlp.postprocessor import PostProcessor
+    from yt_dlp.utils import DownloadCancelled, YoutubeDLError
+except ImportError:  # Only the executable is installed - use the subprocess engine
+    yt_dlp = None
+
+# Static files are served by serve_static() from an allowlist, not the whole app directory
+app = Flask(__name__, static_folder=None)
 
 # Error handler to ensure JSON responses for API errors
 
@@ -35,257 +60,1831 @@ def not_found(error):
 
 
 # Create a temporary directory for downloads
-DOWNLOAD_DIR = os.path.join(os.path.dirname(__file__), 'downloads')
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', os.path.join(
+    os.path.dirname(__file__), 'downloads'))
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+# Job store, audio cache and partial downloads. Kept out of the app directory,
+# whose files are the site's static root.
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(
+    os.getenv('XDG_DATA_HOME', os.path.expanduser('~/.local/share')), 'link-downloader'))
+os.makedirs(DATA_DIR, exist_ok=True)
+
 # Cookie file path for YouTube authentication
 # Export cookies from your browser and save to this location
 COOKIES_FILE = os.path.join(os.path.dirname(__file__), 'cookies.txt')
 
 
-def clean_youtube_url(url):
-    """Clean YouTube URLs by removing query parameters after the video ID"""
+# YouTube video IDs are always 11 characters from this alphabet
+YOUTUBE_ID_RE = re.compile(r'^[0-9A-Za-z_-]{11}$')
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com',
+                 'youtube-nocookie.com', 'www.youtube-nocookie.com')
+# youtube.com/<prefix>/<id> paths that name a single video
+YOUTUBE_VIDEO_PATHS = ('shorts', 'embed', 'live', 'v', 'e')
+
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = ('fbclid', 'gclid', 'si', 'feature', 'ref', 'ref_src')
+
+# yt-dlp's fallback extractor for direct files and unknown pages. Its "ID" is
+# just the file name, so /a/song.wav and /b/song.wav on any two sites share one
+GENERIC_EXTRACTOR = 'Generic'
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _youtube_video_id(parsed):
+    """The video ID of a parsed YouTube URL, or None for playlists, channels and other pages"""
+    host = (parsed.hostname or '').lower()
+    path = [part for part in parsed.path.split('/') if part]
+    video_id = None
+    if host == 'youtu.be':
+        video_id = path[0] if path else None
+    elif host in YOUTUBE_HOSTS:
+        if path == ['watch']:
+            video_id = (parse_qs(parsed.query).get('v') or [None])[0]
+        elif len(path) >= 2 and path[0] in YOUTUBE_VIDEO_PATHS:
+            video_id = path[1]
+    return video_id if video_id and YOUTUBE_ID_RE.match(video_id) else None
+
+
+def _known_media_key(parsed):
+    """Fast path: (extractor, media ID) for hosts whose URLs carry the ID yt-dlp reports"""
+    video_id = _youtube_video_id(parsed)
+    if video_id:
+        return ('Youtube', video_id)
+
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    path = [part for part in parsed.path.split('/') if part]
+    if host == 'vimeo.com' and path and path[-1].isdigit():
+        return ('Vimeo', path[-1])
+    if host == 'player.vimeo.com' and len(path) == 2 and path[0] == 'video' and path[1].isdigit():
+        return ('Vimeo', path[1])
+    if host == 'dailymotion.com' and len(path) == 2 and path[0] == 'video':
+        return ('Dailymotion', path[1].split('_')[0])
+    if host == 'dai.ly' and len(path) == 1:
+        return ('Dailymotion', path[0])
+    return None
+
+
+def media_key(url):
+    """(extractor, media ID) for a URL, or None if it can't be known before extraction.
+
+    Uses the fast paths above, then metadata cached by /validate. The key is
+    the one yt-dlp reports after downloading (the URL stands in for Generic
+    IDs), so it also indexes AUDIO_CACHE.
+    """
+    key = _known_media_key(urlparse(url.strip()))
+    if key is not None:
+        return key
+    info = INFO_CACHE.get(url)
+    if info and info.get('extractor_key') == GENERIC_EXTRACTOR:
+        return generic_media_key(url)
+    if info and info.get('id') and info.get('extractor_key') and info.get('_type', 'video') == 'video':
+        return (info['extractor_key'], info['id'])
+    return None
+
+
+def _url_identity(url):
+    """(scheme, host, path, query) of a URL, ignoring case of the host, www., a default
+    port, fragments and tracking parameters"""
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    try:
+        port = parsed.port
+    except ValueError:
+        port = None
+        host = parsed.netloc.lower()  # Not a valid port, but still part of what was asked for
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    query = sorted((name, value) for name, value in parse_qsl(parsed.query, keep_blank_values=True)
+                   if name not in TRACKING_PARAMS and not name.startswith('utm_'))
+    return scheme, host, parsed.path.rstrip('/'), tuple(query)
+
+
+def generic_media_key(url):
+    """Media key for a link handled by the Generic extractor: the URL itself stands in for the ID"""
+    scheme, host, path, query = _url_identity(url)
+    return (GENERIC_EXTRACTOR, f'{scheme}://{host}{path}' + ('?' + urlencode(query) if query else ''))
+
+
+def link_key(url):
+    """Key under which two submitted links count as the same download"""
+    key = media_key(url)
+    if key is not None and key[0] != GENERIC_EXTRACTOR:
+        return key
+    # Same page. Generic media are keyed by their URL too, so this key doesn't
+    # change with whether /validate has seen the link
+    return ('url', *_url_identity(url))
+
+
+def canonical_url(url):
+    """Strip whitespace, and reduce YouTube video links of any shape to a plain watch URL"""
     if not url:
         return url
-
     url = url.strip()
-
-    # Check if it's a YouTube URL
-    if 'youtube.com' in url or 'youtu.be' in url:
-        # Handle youtube.com/watch?v=VIDEO_ID&other_params
-        if 'watch?v=' in url:
-            # Split on '?' to get base URL and query string
-            base_url = url.split('?')[0]
-            query_string = url.split('?')[1] if '?' in url else ''
-
-            # Extract just the v= parameter
-            if 'v=' in query_string:
-                video_id = query_string.split('v=')[1].split('&')[0]
-                return f"{base_url}?v={video_id}"
-
-        # Handle youtu.be/VIDEO_ID?other_params
-        elif 'youtu.be/' in url:
-            # Split on '?' to remove query parameters
-            return url.split('?')[0]
-
-    # Return original URL if not YouTube or doesn't match patterns
+    video_id = _youtube_video_id(urlparse(url))
+    if video_id:
+        # Drops timestamps, playlist context and share tracking along with the host variant
+        return f'https://www.youtube.com/watch?v={video_id}'
     return url
 
 
-def download_audio(url, output_dir):
-    """Download audio from a URL using yt-dlp"""
+# Seconds one link may spend in yt-dlp across all of its fallback attempts.
+# Each attempt only gets what's left, so a stuck URL holds a worker for at most this long.
+LINK_TIMEOUT_SECONDS = int(os.getenv('LINK_TIMEOUT_SECONDS', '600'))
+
+# Another fallback attempt isn't started with less than this left of the link's budget
+MIN_ATTEMPT_SECONDS = 5
+
+# Seconds a timed-out yt-dlp process group gets to exit after SIGTERM before SIGKILL
+KILL_GRACE_SECONDS = 5
+
+# How often a running yt-dlp process is checked for cancellation (hedged races)
+CANCEL_POLL_SECONDS = 0.5
+
+# Download engine: 'inprocess' drives yt_dlp.YoutubeDL inside this process,
+# 'subprocess' spawns the yt-dlp executable for every attempt
+DOWNLOAD_ENGINE = os.getenv(
+    'DOWNLOAD_ENGINE', 'inprocess' if yt_dlp is not None else 'subprocess')
+
+# Strategy: Try multiple approaches for YouTube to bypass bot detection
+# 1. Try default player client (requires Node.js) - most reliable
+# 2. Try Android client (no Node.js needed, less likely to trigger bot detection)
+# 3. Try Android client with impersonate
+# 4. Web client as last resort
+YOUTUBE_STRATEGIES = [
+    {'name': 'default', 'player_client': 'default',
+        'impersonate': None, 'audio_format': 'm4a'},
+    {'name': 'android', 'player_client': 'android',
+        'impersonate': None, 'audio_format': 'm4a'},
+    {'name': 'android_impersonate', 'player_client': 'android',
+        'impersonate': 'chrome', 'audio_format': 'm4a'},
+    {'name': 'web', 'player_client': 'web',
+        'impersonate': None, 'audio_format': 'm4a'},
+]
+
+# 5. If format error, try without specifying format (let yt-dlp choose best)
+FORMAT_FALLBACK_STRATEGY = {'name': 'format_fallback', 'player_client': 'android',
+                            'impersonate': None, 'audio_format': None}
+
+# For non-YouTube URLs, use standard options
+STANDARD_STRATEGY = {'name': 'standard', 'player_client': None,
+                     'impersonate': None, 'audio_format': 'm4a'}
+
+# Download straight from metadata /validate already extracted
+CACHED_INFO_STRATEGY = {'name': 'cached_info', 'player_client': None,
+                        'impersonate': None, 'audio_format': 'm4a'}
+
+# Prefer source streams already in the target codec: ffmpeg then only remuxes them
+# instead of re-encoding, which is the main CPU cost per download. PREFER_REMUX=0
+# picks the best audio regardless of codec (e.g. Opus) and transcodes it.
+PREFER_REMUX = os.getenv('PREFER_REMUX', '1') != '0'
+# Keyed by the strategies' audio_format; m4a is the only target they use
+REMUX_FORMAT_SELECTORS = {
+    'm4a': 'bestaudio[acodec^=mp4a]/bestaudio[ext=m4a]/bestaudio/best',
+}
+# Source codecs (acodec prefixes) FFmpegExtractAudio copies rather than re-encodes per target
+REMUX_COMPATIBLE_CODECS = {'m4a': ('mp4a', 'aac')}
+
+
+def format_selector(strategy):
+    """yt-dlp format selection for a strategy's target audio format"""
+    if PREFER_REMUX and strategy['audio_format'] in REMUX_FORMAT_SELECTORS:
+        return REMUX_FORMAT_SELECTORS[strategy['audio_format']]
+    return 'bestaudio/best'
+
+
+def conversion_path(acodec, audio_format):
+    """'remux' if the downloaded audio only needed repackaging, 'transcode' if ffmpeg re-encoded it"""
+    if not acodec or acodec == 'none':
+        return None  # yt-dlp didn't report the codec
+    if audio_format is None:
+        return 'remux'  # No target codec - the source codec is kept
+    codec = acodec.split('.')[0].lower()
+    if codec in REMUX_COMPATIBLE_CODECS.get(audio_format, (audio_format,)):
+        return 'remux'
+    return 'transcode'
+
+
+# Fragmented (DASH/HLS) sources are fetched up to FRAGMENT_CONCURRENCY fragments
+# at a time per download. Every connection past a download's first one comes
+# out of MAX_FRAGMENT_CONNECTIONS, shared by all downloads (see FragmentBudget).
+FRAGMENT_CONCURRENCY = int(os.getenv('FRAGMENT_CONCURRENCY', '4'))
+# Memory kept free per extra fragment connection (buffered fragment + thread/socket)
+FRAGMENT_MEMORY_MB = int(os.getenv('FRAGMENT_MEMORY_MB', '16'))
+# yt-dlp protocols that are downloaded fragment by fragment
+FRAGMENTED_PROTOCOLS = ('m3u8', 'http_dash_segments', 'ism', 'f4m')
+
+# Optional external downloader (e.g. aria2c) for DASH/HLS sources only - plain
+# HTTP downloads stay on yt-dlp's own downloader. Empty uses yt-dlp's for everything.
+EXTERNAL_DOWNLOADER = os.getenv('EXTERNAL_DOWNLOADER', '').strip()
+EXTERNAL_DOWNLOADER_PROTOCOLS = ('dash', 'm3u8')
+
+
+def is_fragmented(info):
+    """Whether a download may be fragmented (False when there's no metadata to tell:
+    most such links are plain HTTPS files that would never use the extra connections)"""
+    if info is None:
+        return False
+    formats = info.get('formats') or [info]
+    return any(str(f.get('protocol') or '').startswith(FRAGMENTED_PROTOCOLS)
+               for f in formats if f.get('acodec') != 'none')
+
+
+def external_downloader_args(connections):
+    """Arguments capping the external downloader at a download's connection grant"""
+    if os.path.basename(EXTERNAL_DOWNLOADER) == 'aria2c':
+        # aria2c defaults to 16 connections per download; the last value wins
+        return [f'-x{connections}', f'-s{connections}', f'-j{connections}']
+    return []
+
+
+def transfer_cli_args(connections):
+    """yt-dlp arguments for concurrent fragments and the external downloader"""
+    args = ['--concurrent-fragments', str(connections)]
+    if EXTERNAL_DOWNLOADER:
+        args += ['--downloader',
+                 f"{','.join(EXTERNAL_DOWNLOADER_PROTOCOLS)}:{EXTERNAL_DOWNLOADER}"]
+        extra = external_downloader_args(connections)
+        if extra:
+            args += ['--downloader-args',
+                     f'{os.path.basename(EXTERNAL_DOWNLOADER)}:{shlex.join(extra)}']
+    return args
+
+
+def transfer_opts(connections):
+    """YoutubeDL options equivalent to transfer_cli_args()"""
+    opts = {'concurrent_fragment_downloads': connections}
+    if EXTERNAL_DOWNLOADER:
+        opts['external_downloader'] = {protocol: EXTERNAL_DOWNLOADER
+                                       for protocol in EXTERNAL_DOWNLOADER_PROTOCOLS}
+        opts['external_downloader_args'] = {
+            os.path.basename(EXTERNAL_DOWNLOADER): external_downloader_args(connections)}
+    return opts
+
+
+# Upper bounds (seconds) of the latency histogram buckets exposed on /metrics
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Metrics:
+    """In-process counters and histograms, rendered in the Prometheus text format.
+
+    Updates are a dict lookup and an add under one lock, so they're cheap
+    enough to call from download hooks.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._help = {}        # name -> (type, help)
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        slot = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                slot = i
+                break
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[slot] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        parts = []
+        for key, value in list(labels) + list(extra):
+            value = str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self, samples=()):
+        """Exposition text for every metric plus samples read at scrape time, as (name, labels, value)"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(values))
+                                for key, values in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, help_text = self._help[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+            described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), values in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(
+                f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {values[-1]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {values[-2]:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} {values[-1]}')
+        for name, labels, value in samples:
+            header(name)
+            lines.append(
+                f'{name}{self._labels(sorted(labels.items()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(STAGE_BUCKETS)
+METRICS.describe('linkdl_stage_seconds', 'histogram',
+                 'Time spent per stage: queue, metadata, extract, download, postprocess, zip, job')
+METRICS.describe('linkdl_downloaded_bytes_total', 'counter',
+                 'Bytes transferred by yt-dlp, excluding audio cache hits')
+METRICS.describe('linkdl_links_total', 'counter',
+                 'Finished links by result')
+METRICS.describe('linkdl_conversions_total', 'counter',
+                 'Finished links by audio path: remux, transcode, cached or shared')
+METRICS.describe('linkdl_hedges_total', 'counter',
+                 'Hedged strategy races by outcome: primary_won, backup_won, neither_won, no_capacity')
+METRICS.describe('linkdl_timeouts_total', 'counter',
+                 'Links that ran out of their deadline, by the stage they were in')
+METRICS.describe('linkdl_strategy_attempts_total', 'counter',
+                 'Download attempts per yt-dlp strategy')
+METRICS.describe('linkdl_strategy_successes_total', 'counter',
+                 'Successful download attempts per yt-dlp strategy')
+METRICS.describe('linkdl_queue_depth', 'gauge',
+                 'Downloads waiting for a worker')
+METRICS.describe('linkdl_active_workers', 'gauge',
+                 'Downloads running right now')
+METRICS.describe('linkdl_fragment_connections', 'gauge',
+                 'Extra fragment connections granted to running downloads')
+METRICS.describe('linkdl_cache_hit_ratio', 'gauge',
+                 'Hits / (hits + misses) per cache since startup')
+METRICS.describe('linkdl_cookies_age_seconds', 'gauge',
+                 'Seconds since cookies.txt was last written (-1 if missing)')
+METRICS.describe('linkdl_download_dir_bytes', 'gauge',
+                 'Bytes in downloads/ at the last janitor sweep')
+
+
+class StageClock:
+    """Turns progress(phase, ...) reports into per-stage timings and a byte count"""
+
+    STAGES = {'extracting': 'extract', 'downloading': 'download',
+              'post-processing': 'postprocess'}
+
+    def __init__(self, progress=None):
+        self.progress = progress
+        self._stage = None
+        self._since = None
+        self._bytes = 0  # Latest downloaded_bytes of the file in flight
+
+    def __call__(self, phase, **fields):
+        stage = self.STAGES.get(phase)
+        if stage != self._stage:
+            self._close()
+            self._stage, self._since = stage, time.time()
+        if phase == 'downloading':
+            downloaded = fields.get('downloaded_bytes') or 0
+            # yt-dlp restarts the count for each file (e.g. separate audio and video)
+            if downloaded < self._bytes:
+                METRICS.inc('linkdl_downloaded_bytes_total', self._bytes)
+            self._bytes = downloaded
+        if self.progress is not None:
+            self.progress(phase, **fields)
+
+    def _close(self):
+        if self._stage is not None:
+            METRICS.observe('linkdl_stage_seconds',
+                            time.time() - self._since, stage=self._stage)
+        if self._bytes:
+            METRICS.inc('linkdl_downloaded_bytes_total', int(self._bytes))
+            self._bytes = 0
+        self._stage = None
+
+    def finish(self):
+        """Record the stage that was running when the attempt ended, and return it"""
+        stage = self._stage
+        self._close()
+        return stage
+
+
+# Strategy outcomes older than this (or beyond the last N attempts) stop counting
+STRATEGY_WINDOW_SECONDS = int(os.getenv('STRATEGY_WINDOW_SECONDS', '1800'))
+STRATEGY_WINDOW_SIZE = 50
+
+
+class StrategyStats:
+    """Sliding-window success/latency tracking used to order the fallback strategies"""
+
+    def __init__(self, window_seconds, window_size):
+        self.window_seconds = window_seconds
+        self.window_size = window_size
+        self._lock = threading.Lock()
+        self._recent = {}    # name -> deque of (timestamp, success, seconds)
+        self._totals = {}    # name -> {'attempts': n, 'successes': n}
+
+    def record(self, name, success, seconds):
+        with self._lock:
+            self._recent.setdefault(name, deque(maxlen=self.window_size)).append(
+                (time.time(), success, seconds))
+            totals = self._totals.setdefault(
+                name, {'attempts': 0, 'successes': 0})
+            totals['attempts'] += 1
+            totals['successes'] += 1 if success else 0
+
+    def _window(self, name):
+        cutoff = time.time() - self.window_seconds
+        return [entry for entry in self._recent.get(name, ()) if entry[0] >= cutoff]
+
+    def _score(self, name):
+        window = self._window(name)
+        successes = sum(1 for _, success, _ in window if success)
+        # Smoothed success rate: strategies with no recent data score 0.5,
+        # so a demoted strategy gets retried once its failures age out
+        rate = (successes + 1) / (len(window) + 2)
+        latencies = [seconds for _, success, seconds in window if success]
+        latency = sum(latencies) / len(latencies) if latencies else float('inf')
+        return rate, latency
+
+    def ordered(self, strategies):
+        """Strategies sorted best-first: success rate, then latency, then configured order"""
+        with self._lock:
+            scores = {s['name']: self._score(s['name']) for s in strategies}
+        return sorted(strategies, key=lambda s: (-round(scores[s['name']][0], 2),
+                                                 scores[s['name']][1],
+                                                 strategies.index(s)))
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for name, totals in self._totals.items():
+                window = self._window(name)
+                rate, latency = self._score(name)
+                result[name] = {
+                    'attempts': totals['attempts'],
+                    'successes': totals['successes'],
+                    'window_attempts': len(window),
+                    'window_successes': sum(1 for _, success, _ in window if success),
+                    'score': round(rate, 3),
+                    'avg_success_seconds': round(latency, 2) if latency != float('inf') else None,
+                }
+            return result
+
+
+STRATEGY_STATS = StrategyStats(STRATEGY_WINDOW_SECONDS, STRATEGY_WINDOW_SIZE)
+
+
+def locate_yt_dlp():
+    """Locate the yt-dlp executable, returning None if it isn't installed"""
+    # Find yt-dlp in PATH (should work now that PATH includes ~/.local/bin)
+    yt_dlp_path = shutil.which('yt-dlp')
+
+    # Fallback: if PATH doesn't work, try common locations (safety net)
+    if not yt_dlp_path:
+        for path in ['/home/ubuntu/.local/bin/yt-dlp', '/home/ec2-user/.local/bin/yt-dlp',
+                     '/usr/local/bin/yt-dlp', '/usr/bin/yt-dlp', 'yt-dlp']:
+            if os.path.exists(path) or path == 'yt-dlp':
+                yt_dlp_path = path
+                break
+
+    if not yt_dlp_path or (yt_dlp_path != 'yt-dlp' and not os.path.exists(yt_dlp_path)):
+        return None
+    return yt_dlp_path
+
+
+def probe_yt_dlp_version(yt_dlp_path):
+    """Run `yt-dlp --version`, returning the version string or None"""
     try:
-        # Find yt-dlp in PATH (should work now that PATH includes ~/.local/bin)
-        yt_dlp_path = shutil.which('yt-dlp')
+        version_check = subprocess.run(
+            [yt_dlp_path, '--version'],
+            capture_output=True,
+            text=True,
+            timeout=5
+        )
+        if version_check.returncode == 0:
+            version = version_check.stdout.strip()
+            print(f"Using yt-dlp version: {version} from: {yt_dlp_path}")
+            # Warn if using system-installed version (might be old)
+            if '/usr/bin/yt-dlp' in yt_dlp_path:
+                print(
+                    f"Warning: Using system-installed yt-dlp. Consider using pip version: pip install --upgrade yt-dlp")
+            # Warn if version seems old
+            if version and not version.startswith('2025') and not version.startswith('2024'):
+                print(
+                    f"Warning: yt-dlp version {version} may be outdated. Consider updating: pip install --upgrade yt-dlp")
+            return version
+    except Exception as e:
+        print(f"Warning: Could not check yt-dlp version: {e}")
+    return None
 
-        # Fallback: if PATH doesn't work, try common locations (safety net)
-        if not yt_dlp_path:
-            for path in ['/home/ubuntu/.local/bin/yt-dlp', '/home/ec2-user/.local/bin/yt-dlp',
-                         '/usr/local/bin/yt-dlp', '/usr/bin/yt-dlp', 'yt-dlp']:
-                if os.path.exists(path) or path == 'yt-dlp':
-                    yt_dlp_path = path
-                    break
 
-        if not yt_dlp_path or (yt_dlp_path != 'yt-dlp' and not os.path.exists(yt_dlp_path)):
-            return False, "yt-dlp not found. Please install it: pip install yt-dlp"
+def _file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class ToolRegistry:
+    """External tools resolved once at startup and re-probed only when the binary changes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._yt_dlp = None
+        self.probe_count = 0
+
+    def _probe(self):
+        path = locate_yt_dlp()
+        self.probe_count += 1
+        self._yt_dlp = {
+            'path': path,
+            'version': probe_yt_dlp_version(path) if path else None,
+            'mtime': _file_mtime(path) if path else None,
+            'probed_at': time.time(),
+        }
+
+    def yt_dlp_path(self):
+        """Path of the yt-dlp executable, re-probing if it was upgraded since the last check"""
+        with self._lock:
+            cached = self._yt_dlp
+            if cached is None or cached['path'] is None:
+                self._probe()
+            elif cached['mtime'] is not None and _file_mtime(cached['path']) != cached['mtime']:
+                print(f"yt-dlp at {cached['path']} changed, re-probing")
+                self._probe()
+            return self._yt_dlp['path']
+
+    def describe(self):
+        """Resolved tool details for /status"""
+        with self._lock:
+            if self._yt_dlp is None:
+                self._probe()
+            return {
+                'engine': DOWNLOAD_ENGINE,
+                'yt_dlp_executable': {k: self._yt_dlp[k] for k in ('path', 'version', 'probed_at')},
+                'yt_dlp_module': yt_dlp.version.__version__ if yt_dlp is not None else None,
+                'ffmpeg': shutil.which('ffmpeg'),
+                'probe_count': self.probe_count,
+            }
+
+
+TOOLS = ToolRegistry()
+
+
+def check_cookies_file():
+    """Return True if the cookies file exists and is usable"""
+    use_cookies = os.path.exists(COOKIES_FILE)
+    if use_cookies:
+        # Check if cookies file is not empty
+        if os.path.getsize(COOKIES_FILE) == 0:
+            print(f"Warning: Cookies file is empty at {COOKIES_FILE}")
+            use_cookies = False
+        else:
+            # Get file modification time for logging
+            try:
+                mtime = os.path.getmtime(COOKIES_FILE)
+                mtime_str = time.strftime(
+                    '%Y-%m-%d %H:%M:%S', time.localtime(mtime))
+                file_size = os.path.getsize(COOKIES_FILE)
+                print(
+                    f"Using cookies file: {COOKIES_FILE} (size: {file_size} bytes, modified: {mtime_str})")
+            except Exception:
+                print(f"Using cookies file: {COOKIES_FILE}")
+    else:
+        print(
+            f"Warning: Cookies file not found at {COOKIES_FILE}. Some downloads may fail.")
+    return use_cookies
+
+
+# Markers for the progress lines requested from the yt-dlp executable
+CLI_DOWNLOAD_PROGRESS_PREFIX = '[ld-progress]'
+CLI_POSTPROCESS_PROGRESS_PREFIX = '[ld-postprocess]'
+
+
+def build_cli_args(strategy, url, output_dir, use_cookies, info_file=None, connections=1,
+                   partial_dir=None):
+    """Build the yt-dlp command line arguments for one strategy"""
+
+    # Optimized for 1GB RAM: larger buffer for efficiency, no rate limit for speed
+    args = [
+        # Increased from 16K for better performance (uses ~64KB RAM)
+        '--buffer-size', '64K',
+        # Removed --limit-rate to use full available bandwidth
+        '--no-warnings',  # Reduce noise in logs
+        '-x',  # Extract audio only
+        '-f', format_selector(strategy),
+    ] + transfer_cli_args(connections)
+    if strategy['audio_format']:
+        args += ['--audio-format', strategy['audio_format']]
+    # Create a safe filename - yt-dlp uses %(title)s.%(ext)s format. The template
+    # stays relative so a temp path (partial_dir) applies to it as well.
+    args += ['-P', output_dir, '-o', '%(title)s.%(ext)s']
+    if partial_dir:
+        args += ['-P', f'temp:{partial_dir}',
+                 '--exec', 'before_dl:' + PartialDownloads.match_format_command(partial_dir)]
+    # Report the final file so the result can be cached (JSON on stdout)
+    args += ['--print', 'after_move:%(.{extractor_key,id,title,filepath,acodec})j']
+    # One machine-readable progress line per update (--print implies --quiet, so force it)
+    args += ['--progress', '--newline',
+             '--progress-template', 'download:' + CLI_DOWNLOAD_PROGRESS_PREFIX +
+             ' %(progress.downloaded_bytes)s %(progress.total_bytes)s'
+             ' %(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s',
+             '--progress-template', 'postprocess:' + CLI_POSTPROCESS_PROGRESS_PREFIX +
+             ' %(progress.status)s %(progress.postprocessor)s']
+    args += ['--load-info-json', info_file] if info_file else [url]
+
+    if strategy['player_client']:
+        args = ['--extractor-args',
+                f"youtube:player_client={strategy['player_client']}"] + args
+    if strategy['impersonate']:
+        args = ['--impersonate', strategy['impersonate']] + args
+
+    # Add cookies if available
+    if use_cookies:
+        args = ['--cookies', COOKIES_FILE] + args
+    return args
+
+
+def build_ydl_opts(strategy, use_cookies):
+    """Build the YoutubeDL options equivalent to build_cli_args()"""
+    opts = {
+        **transfer_opts(1),
+        'buffersize': 64 * 1024,
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'format': format_selector(strategy),
+        'outtmpl': {'default': '%(title)s.%(ext)s'},
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': strategy['audio_format'] or 'best',
+        }],
+        'progress_hooks': [_inprocess_progress_hook],
+        'postprocessor_hooks': [_inprocess_postprocessor_hook],
+    }
+    if strategy['player_client']:
+        opts['extractor_args'] = {
+            'youtube': {'player_client': [strategy['player_client']]}}
+    if strategy['impersonate']:
+        opts['impersonate'] = ImpersonateTarget.from_str(
+            strategy['impersonate'])
+    if use_cookies:
+        opts['cookiefile'] = COOKIES_FILE
+    return opts
+
+
+# YoutubeDL instances aren't thread-safe, so each scheduler worker keeps its own.
+# Reusing them keeps extractors loaded and HTTP connections open between jobs.
+_ENGINE_LOCAL = threading.local()
+
+
+def _check_inprocess_abort():
+    """Stop this thread's download once it's past its deadline or lost a hedged race"""
+    deadline = getattr(_ENGINE_LOCAL, 'deadline', None)
+    if deadline is not None and time.time() > deadline:
+        raise DownloadCancelled('Download timeout')
+    cancel = getattr(_ENGINE_LOCAL, 'cancel', None)
+    if cancel is not None and cancel.is_set():
+        raise DownloadCancelled('Cancelled: another attempt finished first')
+
+
+def _inprocess_progress_hook(progress):
+    """Forward yt-dlp download progress and abort downloads past their deadline"""
+    _check_inprocess_abort()
+
+    report = getattr(_ENGINE_LOCAL, 'progress', None)
+    if report is not None and progress.get('status') == 'downloading':
+        report('downloading',
+               downloaded_bytes=progress.get('downloaded_bytes'),
+               total_bytes=progress.get('total_bytes') or progress.get(
+                   'total_bytes_estimate'),
+               speed=progress.get('speed'),
+               eta=progress.get('eta'))
+
+
+def _inprocess_postprocessor_hook(progress):
+    # ffmpeg can't be interrupted once running, so at least don't start it late
+    _check_inprocess_abort()
+
+    report = getattr(_ENGINE_LOCAL, 'progress', None)
+    if report is not None and progress.get('status') == 'started':
+        report('post-processing', step=progress.get('postprocessor'))
+
+
+def parse_progress_line(line):
+    """Turn a yt-dlp progress template line into (phase, fields), or None for other output"""
+    def number(value):
+        try:
+            return float(value)
+        except ValueError:
+            return None  # yt-dlp prints NA for unknown values
+
+    parts = line.split()
+    if len(parts) == 6 and parts[0] == CLI_DOWNLOAD_PROGRESS_PREFIX:
+        downloaded, total, estimate, speed, eta = [
+            number(v) for v in parts[1:]]
+        return 'downloading', {'downloaded_bytes': downloaded, 'total_bytes': total or estimate,
+                               'speed': speed, 'eta': eta}
+    if len(parts) == 3 and parts[0] == CLI_POSTPROCESS_PROGRESS_PREFIX:
+        if parts[1] == 'started':
+            return 'post-processing', {'step': parts[2]}
+        return 'post-processing', None
+    return None
+
+
+if yt_dlp is not None:
+    class DeadlineYoutubeDL(yt_dlp.YoutubeDL):
+        """YoutubeDL whose requests can't outlast the calling thread's deadline.
+
+        The hooks only run between download chunks and post-processing steps,
+        so this is what bounds extraction requests and stalled connections:
+        each request's socket timeout is capped to the time that's left.
+        """
+
+        def urlopen(self, req):
+            _check_inprocess_abort()
+            deadline = getattr(_ENGINE_LOCAL, 'deadline', None)
+            if isinstance(req, str):
+                req = YtDlpRequest(req)
+            if deadline is not None and isinstance(req, YtDlpRequest):
+                timeout = (req.extensions.get('timeout') or self.params.get('socket_timeout')
+                           or YT_DLP_SOCKET_TIMEOUT)
+                req.extensions['timeout'] = max(min(timeout, deadline - time.time()), 1)
+            return super().urlopen(req)
+
+    class PartialFormatPP(PostProcessor):
+        """Runs before each download: see PartialDownloads.match_format()"""
+
+        def run(self, info):
+            partial_dir = (self._downloader.params.get('paths') or {}).get('temp')
+            if partial_dir:
+                PARTIAL_DOWNLOADS.match_format(partial_dir, info.get('format_id'),
+                                               info.get('filesize'))
+            return [], info
+
+
+def get_youtube_dl(strategy, use_cookies):
+    """Return this thread's YoutubeDL instance for a strategy, creating it on first use"""
+    instances = getattr(_ENGINE_LOCAL, 'instances', None)
+    if instances is None:
+        instances = _ENGINE_LOCAL.instances = {}
+
+    # Re-create instances when cookies.txt changes so fresh cookies get loaded
+    cookies_mtime = os.path.getmtime(COOKIES_FILE) if use_cookies else None
+    key = (strategy['name'], cookies_mtime)
+    ydl = instances.get(key)
+    if ydl is None:
+        for old_key in [k for k in instances if k[0] == strategy['name']]:
+            instances.pop(old_key).close()
+        ydl = instances[key] = DeadlineYoutubeDL(
+            build_ydl_opts(strategy, use_cookies))
+        ydl.add_post_processor(PartialFormatPP(ydl), when='before_dl')
+    return ydl
+
+
+def media_from_info(info):
+    """The fields of a finished yt-dlp result needed to identify and cache its file"""
+    downloads = info.get('requested_downloads') or [{}]
+    return {
+        'extractor_key': info.get('extractor_key'),
+        'id': info.get('id'),
+        'title': info.get('title'),
+        'filepath': downloads[-1].get('filepath') or info.get('filepath'),
+        # Codec of the downloaded stream, before any conversion
+        'acodec': downloads[-1].get('acodec') or info.get('acodec'),
+    }
+
+
+def run_strategy_inprocess(strategy, url, output_dir, use_cookies, deadline, info=None,
+                           progress=None, connections=1, cancel=None, partial_dir=None):
+    """Run one download attempt with yt_dlp.YoutubeDL, returning (success, error_text, media)"""
+    ydl = get_youtube_dl(strategy, use_cookies)
+    ydl.params['paths'] = {'home': output_dir}
+    if partial_dir:
+        ydl.params['paths']['temp'] = partial_dir
+    ydl.params.update(transfer_opts(connections))
+    _ENGINE_LOCAL.deadline = deadline
+    _ENGINE_LOCAL.progress = progress
+    _ENGINE_LOCAL.cancel = cancel
+    try:
+        if info is not None:
+            result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+        else:
+            result = ydl.extract_info(url, download=True)
+        return True, None, media_from_info(result or {})
+    except YoutubeDLError as e:
+        # Includes DownloadCancelled raised by the timeout hook
+        return False, str(e), None
+    finally:
+        _ENGINE_LOCAL.deadline = None
+        _ENGINE_LOCAL.progress = None
+        _ENGINE_LOCAL.cancel = None
+
 
-        # Check yt-dlp version (for debugging)
+def kill_process_tree(process, grace=KILL_GRACE_SECONDS):
+    """Stop a process started with start_new_session=True and everything it spawned"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
         try:
-            version_check = subprocess.run(
-                [yt_dlp_path, '--version'],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if version_check.returncode == 0:
-                version = version_check.stdout.strip()
-                print(f"Using yt-dlp version: {version} from: {yt_dlp_path}")
-                # Warn if using system-installed version (might be old)
-                if '/usr/bin/yt-dlp' in yt_dlp_path:
-                    print(
-                        f"Warning: Using system-installed yt-dlp. Consider using pip version: pip install --upgrade yt-dlp")
-                # Warn if version seems old
-                if version and not version.startswith('2025') and not version.startswith('2024'):
-                    print(
-                        f"Warning: yt-dlp version {version} may be outdated. Consider updating: pip install --upgrade yt-dlp")
-        except Exception as e:
-            print(f"Warning: Could not check yt-dlp version: {e}")
+            process.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            pass
+        # Whatever is left of the group (ffmpeg ignoring SIGTERM, orphans) goes now
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # The whole group already exited
+    process.wait()
+
+
+def run_yt_dlp_process(cmd, timeout, on_progress=None, cancel=None):
+    """Run yt-dlp, passing progress lines to on_progress as they arrive.
+
+    Returns (returncode, stdout, stderr) with progress lines left out of both
+    outputs; raises subprocess.TimeoutExpired after killing the process and
+    everything it started (ffmpeg, external downloaders). Setting the cancel
+    event kills them the same way, and the negative returncode is returned.
+    """
+    # Own session, so a timeout can take down the whole process group
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, bufsize=1, start_new_session=True)
+    output = {'stdout': [], 'stderr': []}
+
+    def pump(stream, name):
+        for line in stream:
+            parsed = parse_progress_line(line)
+            if parsed is None:
+                output[name].append(line)
+            elif on_progress is not None and parsed[1] is not None:
+                on_progress(parsed[0], **parsed[1])
+        stream.close()
+
+    readers = [threading.Thread(target=pump, args=(process.stdout, 'stdout'), daemon=True),
+               threading.Thread(target=pump, args=(process.stderr, 'stderr'), daemon=True)]
+    for reader in readers:
+        reader.start()
+    deadline = time.time() + timeout
+    try:
+        while True:
+            try:
+                process.wait(timeout=max(min(deadline - time.time(), CANCEL_POLL_SECONDS), 0))
+                break
+            except subprocess.TimeoutExpired:
+                if cancel is not None and cancel.is_set():
+                    kill_process_tree(process)
+                    break
+                if time.time() >= deadline:
+                    raise
+    except subprocess.TimeoutExpired:
+        # Children still holding the pipes would otherwise block the readers forever
+        kill_process_tree(process)
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+    return process.returncode, ''.join(output['stdout']), ''.join(output['stderr'])
+
+
+def run_strategy_subprocess(yt_dlp_path, strategy, url, output_dir, use_cookies, deadline,
+                            info=None, progress=None, connections=1, cancel=None,
+                            partial_dir=None):
+    """Run one download attempt with the yt-dlp executable, returning (success, error_text, media)"""
+    info_file = None
+    if info is not None:
+        # Kept outside output_dir so it isn't mistaken for a downloaded file
+        fd, info_file = tempfile.mkstemp(suffix='.info.json', dir=DOWNLOAD_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f)
+    cmd = [yt_dlp_path] + \
+        build_cli_args(strategy, url, output_dir, use_cookies, info_file, connections,
+                       partial_dir)
+    try:
+        returncode, stdout, stderr = run_yt_dlp_process(
+            cmd, max(deadline - time.time(), 0), progress, cancel)
+    except subprocess.TimeoutExpired:
+        return False, "Download timeout", None
+    finally:
+        if info_file:
+            os.remove(info_file)
 
-        # Create a safe filename - yt-dlp uses %(title)s.%(ext)s format
-        output_path = os.path.join(output_dir, '%(title)s.%(ext)s')
+    media = None
+    if returncode == 0:
+        try:
+            media = json.loads(stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            pass  # Older yt-dlp without --print support - the download still worked
+    return returncode == 0, stderr, media
+
+
+class DownloadFlights:
+    """Single-flight table: concurrent requests for the same media share one download.
+
+    The first caller for a key leads and runs yt-dlp; later callers follow and
+    wait for its outcome. A leader that fails passes its error to the
+    followers, since the same strategies would fail the same way. A leader
+    that aborts (an exception escaped) leaves no verdict, so a follower takes
+    over. A follower that gives up waiting just stops waiting.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.led = 0
+        self.followed = 0
+
+    def join(self, key):
+        """Return (flight, True) if the caller must download key, or (running flight, False)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = {'done': threading.Event(), 'outcome': None}
+                self.led += 1
+                return flight, True
+            self.followed += 1
+            return flight, False
+
+    def finish(self, key, flight, outcome):
+        """Publish the leader's (success, error, media), or None if it aborted"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight['outcome'] = outcome
+        flight['done'].set()
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._flights), 'led': self.led, 'followed': self.followed}
+
+
+DOWNLOAD_FLIGHTS = DownloadFlights()
+
+
+def share_file(path, output_dir):
+    """Hard-link (or copy) another download's file into output_dir, returning the new path"""
+    target = os.path.join(output_dir, os.path.basename(path))
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copyfile(path, target)
+    return target
+
+
+def download_audio(url, output_dir, progress=None):
+    """Download audio from a URL using yt-dlp.
+
+    Returns (success, error, media). On success media holds the final
+    'filepath' and 'title' as reported by yt-dlp (None if an old yt-dlp
+    executable couldn't report them) and 'conversion': 'remux', 'transcode',
+    'cached' or 'shared'.
+
+    progress, if given, is called as progress(phase, **fields) while the
+    download moves through extracting, downloading and post-processing.
+
+    Concurrent calls for the same media (by media_cache_key) share one
+    download through DOWNLOAD_FLIGHTS.
+    """
+    cache_key = media_cache_key(url)
+    if cache_key is None:
+        return fetch_audio(url, output_dir, progress)
+
+    deadline = time.time() + LINK_TIMEOUT_SECONDS
+    while True:
+        # Serve repeat requests straight from the audio cache
+        cached = AUDIO_CACHE.fetch(cache_key, output_dir)
+        if cached:
+            print(f"Audio cache hit for: {url}")
+            cached['conversion'] = 'cached'
+            return True, None, cached
+
+        flight, leader = DOWNLOAD_FLIGHTS.join(cache_key)
+        if leader:
+            outcome = None
+            try:
+                outcome = fetch_audio(url, output_dir, progress)
+                return outcome
+            finally:
+                DOWNLOAD_FLIGHTS.finish(cache_key, flight, outcome)
+
+        print(f"Waiting for an identical download already in progress: {url}")
+        if not flight['done'].wait(max(deadline - time.time(), 0)):
+            return False, (f"Timed out after {LINK_TIMEOUT_SECONDS}s waiting for an identical "
+                           f"download already in progress"), None
+        outcome = flight['outcome']
+        if outcome is None:
+            continue  # The leader aborted - take over (or follow whoever did)
+        success, error, media = outcome
+        if not success:
+            return False, error, None
+        # Normally the leader's file is in the audio cache by now; if it wasn't
+        # cacheable, share the leader's own copy
+        if media and media.get('filepath') and os.path.isfile(media['filepath']) and \
+                not AUDIO_CACHE.contains(cache_key):
+            try:
+                shared = dict(media, filepath=share_file(media['filepath'], output_dir),
+                              conversion='shared')
+            except OSError:
+                continue  # Removed in the meantime - download it after all
+            print(f"Shared an identical download for: {url}")
+            return True, None, shared
+
+
+def fetch_audio(url, output_dir, progress=None):
+    """Run yt-dlp for download_audio(), falling back through strategies on failure.
+
+    All attempts share one LINK_TIMEOUT_SECONDS deadline; when it runs out
+    the error names the stage and attempt that were cut off.
+    """
+    try:
+        yt_dlp_path = None
+        if DOWNLOAD_ENGINE != 'inprocess':
+            yt_dlp_path = TOOLS.yt_dlp_path()
+            if not yt_dlp_path:
+                return False, "yt-dlp not found. Please install it: pip install yt-dlp", None
 
         # Check if cookies file exists and is valid
-        use_cookies = os.path.exists(COOKIES_FILE)
-        if use_cookies:
-            # Check if cookies file is not empty
-            if os.path.getsize(COOKIES_FILE) == 0:
-                print(f"Warning: Cookies file is empty at {COOKIES_FILE}")
-                use_cookies = False
-            else:
-                # Get file modification time for logging
+        use_cookies = check_cookies_file()
+
+        produced = {}
+        deadline = time.time() + LINK_TIMEOUT_SECONDS
+        # Partial transfers are kept per media, so a later attempt or restart resumes them
+        partial_key = media_cache_key(url) or link_key(url)
+        attempts = []
+        timed_out = {}  # Where the deadline hit: 'strategy' and 'stage'
+
+        def run_strategy(strategy, info=None, target_dir=None, cancel=None, on_first_bytes=None,
+                         claim=None):
+            """One attempt; in a hedged race it writes to target_dir and only keeps its files if claim() wins"""
+            started = time.time()
+            if deadline - started < MIN_ATTEMPT_SECONDS:
+                timed_out.setdefault('strategy', strategy['name'])
+                timed_out.setdefault('stage', 'queued attempt')
+                return False, 'Download timeout'
+            attempts.append(strategy['name'])
+            target_dir = target_dir or output_dir
+
+            def report(phase, **fields):
+                if on_first_bytes is not None and phase == 'downloading' and fields.get('downloaded_bytes'):
+                    on_first_bytes()
+                if progress is not None:
+                    progress(phase, **fields)
+
+            clock = StageClock(report)
+            clock('extracting', strategy=strategy['name'])
+            # Fallback attempts have no info of their own, but /validate may have seen the link
+            connections = FRAGMENT_BUDGET.acquire(
+                FRAGMENT_CONCURRENCY if is_fragmented(info or INFO_CACHE.get(url)) else 1)
+            # None while another attempt (a hedge, another worker) is resuming this media
+            partial_dir = PARTIAL_DOWNLOADS.acquire(partial_key)
+            try:
+                if yt_dlp_path is None:
+                    success, error_msg, media = run_strategy_inprocess(
+                        strategy, url, target_dir, use_cookies, deadline, info, clock,
+                        connections, cancel, partial_dir)
+                else:
+                    success, error_msg, media = run_strategy_subprocess(
+                        yt_dlp_path, strategy, url, target_dir, use_cookies, deadline, info,
+                        clock, connections, cancel, partial_dir)
+            finally:
+                if partial_dir:
+                    PARTIAL_DOWNLOADS.release(partial_dir)
+                FRAGMENT_BUDGET.release(connections)
+                stage = clock.finish()
+            if not success and cancel is not None and cancel.is_set():
+                return False, 'Cancelled: another attempt finished first'  # Not the strategy's fault
+            if not success and time.time() >= deadline:
+                timed_out.update(strategy=strategy['name'], stage=stage or 'startup')
+            STRATEGY_STATS.record(
+                strategy['name'], success, time.time() - started)
+            if success and claim is not None:
+                if not claim():
+                    return False, 'Cancelled: another attempt finished first'
+                # Won the race - move its files out of the attempt directory
+                for name in os.listdir(target_dir):
+                    shutil.move(os.path.join(target_dir, name), os.path.join(output_dir, name))
+                if media and media.get('filepath'):
+                    media['filepath'] = os.path.join(
+                        output_dir, os.path.basename(media['filepath']))
+            if media:
+                media['conversion'] = conversion_path(
+                    media.pop('acodec', None), strategy['audio_format'])
+                produced.update(media)
+            return success, error_msg
+
+        def run_hedged(primary, backup):
+            """Run primary, racing backup against it if it has no bytes after HEDGE_DELAY_SECONDS.
+
+            Returns (success, error_msg, backup_ran). The backup only starts
+            when the scheduler has a spare worker slot for it.
+            """
+            host = host_key(url)
+            lock = threading.Lock()
+            state = {'winner': None, 'primary_done': False, 'backup': None}
+            cancels = {'primary': threading.Event(), 'backup': threading.Event()}
+            first_bytes = threading.Event()
+            # Separate directories, so two attempts never write the same file name
+            dirs = {'primary': tempfile.mkdtemp(prefix='.attempt-', dir=output_dir)}
+
+            def claim(role):
+                with lock:
+                    if state['winner'] is not None:
+                        return False
+                    state['winner'] = role
+                cancels['backup' if role == 'primary' else 'primary'].set()
+                return True
+
+            def run_backup():
                 try:
-                    mtime = os.path.getmtime(COOKIES_FILE)
-                    mtime_str = time.strftime(
-                        '%Y-%m-%d %H:%M:%S', time.localtime(mtime))
-                    file_size = os.path.getsize(COOKIES_FILE)
-                    print(
-                        f"Using cookies file: {COOKIES_FILE} (size: {file_size} bytes, modified: {mtime_str})")
-                except Exception:
-                    print(f"Using cookies file: {COOKIES_FILE}")
-        else:
-            print(
-                f"Warning: Cookies file not found at {COOKIES_FILE}. Some downloads may fail.")
-
-        # Common options for all commands
-        # Optimized for 1GB RAM: larger buffer for efficiency, no rate limit for speed
-        common_opts = [
-            # Increased from 16K for better performance (uses ~64KB RAM)
-            '--buffer-size', '64K',
-            # Removed --limit-rate to use full available bandwidth
-            '--no-warnings',  # Reduce noise in logs
-            '-x',  # Extract audio only
-            '--audio-format', 'm4a',
-            '-o', output_path,
-            url
-        ]
-
-        # Add cookies if available
-        if use_cookies:
-            common_opts = ['--cookies', COOKIES_FILE] + common_opts
-
-        # Strategy: Try multiple approaches for YouTube to bypass bot detection
-        # 1. Try default player client (requires Node.js) - most reliable
-        # 2. Try Android client (no Node.js needed)
-        # 3. Try with impersonate as fallback
+                    return run_strategy(backup, target_dir=dirs['backup'], cancel=cancels['backup'],
+                                        claim=lambda: claim('backup'))
+                finally:
+                    DOWNLOAD_SCHEDULER.end_hedge(host)
+                    shutil.rmtree(dirs['backup'], ignore_errors=True)
+
+            def start_backup():
+                with lock:
+                    if state['primary_done'] or first_bytes.is_set():
+                        return
+                # Reserved outside the race lock: the scheduler's locks can be held for a
+                # while by workers waiting on admission, and the primary mustn't wait on them
+                if not DOWNLOAD_SCHEDULER.try_start_hedge(host):
+                    METRICS.inc('linkdl_hedges_total', outcome='no_capacity')
+                    return
+                with lock:
+                    # The primary may have got going in the meantime
+                    needed = not (state['primary_done'] or first_bytes.is_set())
+                    if needed:
+                        print(f"{primary['name']} has no data after {HEDGE_DELAY_SECONDS:g}s, "
+                              f"racing {backup['name']} for: {url}")
+                        dirs['backup'] = tempfile.mkdtemp(prefix='.attempt-', dir=output_dir)
+                        state['backup'] = HEDGE_EXECUTOR.submit(run_backup)
+                if not needed:
+                    DOWNLOAD_SCHEDULER.end_hedge(host)
+
+            timer = threading.Timer(HEDGE_DELAY_SECONDS, start_backup)
+            timer.daemon = True
+            timer.start()
+            try:
+                success, error_msg = run_strategy(
+                    primary, target_dir=dirs['primary'], cancel=cancels['primary'],
+                    on_first_bytes=first_bytes.set, claim=lambda: claim('primary'))
+            finally:
+                timer.cancel()
+                with lock:
+                    state['primary_done'] = True
+                    backup_future = state['backup']
+                shutil.rmtree(dirs['primary'], ignore_errors=True)
+
+            if backup_future is None:
+                return success, error_msg, False
+            if state['winner'] != 'primary':
+                # The primary failed or lost, so the backup's result is the link's
+                success, error_msg = backup_future.result()
+            METRICS.inc('linkdl_hedges_total', outcome=f"{state['winner'] or 'neither'}_won")
+            return success, error_msg, True
 
-        result = None
         is_youtube = 'youtube' in url.lower()
 
-        if is_youtube:
-            # Try 1: Default player client with Node.js (most reliable, requires Node.js)
-            print(
-                f"Trying default YouTube player client (requires Node.js) for: {url}")
-            cmd_default = [
-                yt_dlp_path,
-                '--extractor-args', 'youtube:player_client=default',
-            ] + common_opts
-
-            result = subprocess.run(
-                cmd_default,
-                capture_output=True,
-                text=True,
-                timeout=600
-            )
-
-            # Try 2: Android client (no Node.js needed, less likely to trigger bot detection)
-            if result.returncode != 0:
-                print(
-                    f"Default client failed, trying Android client for: {url}")
-                cmd_android = [
-                    yt_dlp_path,
-                    '--extractor-args', 'youtube:player_client=android',
-                ] + common_opts
-
-                result = subprocess.run(
-                    cmd_android,
-                    capture_output=True,
-                    text=True,
-                    timeout=600
-                )
-
-            # Try 3: Android client with impersonate
-            if result.returncode != 0:
-                print(
-                    f"Android client failed, trying with impersonate for: {url}")
-                cmd_impersonate = [
-                    yt_dlp_path,
-                    '--impersonate', 'chrome',
-                    '--extractor-args', 'youtube:player_client=android',
-                ] + common_opts
-
-                result = subprocess.run(
-                    cmd_impersonate,
-                    capture_output=True,
-                    text=True,
-                    timeout=600
-                )
-
-            # Try 4: Web client as last resort
-            if result.returncode != 0:
-                print(f"Trying web client as last resort for: {url}")
-                cmd_web = [
-                    yt_dlp_path,
-                    '--extractor-args', 'youtube:player_client=web',
-                ] + common_opts
-
-                result = subprocess.run(
-                    cmd_web,
-                    capture_output=True,
-                    text=True,
-                    timeout=600
-                )
-
-            # Try 5: If format error, try without specifying format (let yt-dlp choose best)
-            if result.returncode != 0 and ('format is not available' in result.stderr.lower() or
-                                           'requested format' in result.stderr.lower()):
+        # Reuse metadata extracted by /validate so the first attempt skips extraction
+        success, error_msg = False, ''
+        info = INFO_CACHE.get(url)
+        if info is not None and info.get('_type', 'video') == 'video':
+            print(f"Using cached metadata for: {url}")
+            success, error_msg = run_strategy(CACHED_INFO_STRATEGY, info)
+
+        if success:
+            pass
+        elif is_youtube:
+            # Best recent performer first, so a blocked client stops costing every URL an attempt
+            strategies = STRATEGY_STATS.ordered(YOUTUBE_STRATEGIES)
+            i = 0
+            while i < len(strategies):
+                strategy = strategies[i]
+                if i == 0:
+                    print(
+                        f"Trying {strategy['name']} YouTube player client for: {url}")
+                else:
+                    print(
+                        f"{strategies[i - 1]['name']} strategy failed, trying {strategy['name']} for: {url}")
+                if HEDGE_DELAY_SECONDS > 0 and i + 1 < len(strategies):
+                    success, error_msg, raced = run_hedged(strategy, strategies[i + 1])
+                    i += 2 if raced else 1
+                else:
+                    success, error_msg = run_strategy(strategy)
+                    i += 1
+                if success or timed_out:
+                    break
+
+            if not success and not timed_out and ('format is not available' in error_msg.lower() or
+                                'requested format' in error_msg.lower()):
                 print(
                     f"Format error detected, trying with best available audio format for: {url}")
-                # Use fallback options (no specific format - let yt-dlp choose)
-                fallback_opts = [
-                    '--buffer-size', '64K',
-                    '--no-warnings',
-                    '-x',  # Extract audio only (no format specified)
-                    '-o', output_path,
-                    url
-                ]
-                if use_cookies:
-                    fallback_opts = ['--cookies', COOKIES_FILE] + fallback_opts
-
-                # Try Android client with fallback format
-                cmd_fallback = [
-                    yt_dlp_path,
-                    '--extractor-args', 'youtube:player_client=android',
-                ] + fallback_opts
-
-                result = subprocess.run(
-                    cmd_fallback,
-                    capture_output=True,
-                    text=True,
-                    timeout=600
-                )
+                success, error_msg = run_strategy(FORMAT_FALLBACK_STRATEGY)
         else:
-            # For non-YouTube URLs, use standard command
-            cmd_standard = [yt_dlp_path] + common_opts
-            result = subprocess.run(
-                cmd_standard,
-                capture_output=True,
-                text=True,
-                timeout=600
-            )
-
-        if result.returncode == 0:
-            return True, None
+            success, error_msg = run_strategy(STANDARD_STRATEGY)
+
+        if success:
+            if produced.get('extractor_key') and produced.get('id') and produced.get('filepath'):
+                key = (produced['extractor_key'], produced['id'])
+                if key[0] == GENERIC_EXTRACTOR:
+                    key = generic_media_key(url)
+                AUDIO_CACHE.store((*key, AUDIO_CACHE_FORMAT),
+                                  produced['filepath'], produced.get('title'))
+            return True, None, produced or None
+        elif timed_out:
+            METRICS.inc('linkdl_timeouts_total', stage=timed_out['stage'])
+            return False, (f"Timed out after {LINK_TIMEOUT_SECONDS}s: deadline reached during "
+                           f"{timed_out['stage']} of the {timed_out['strategy']} attempt "
+                           f"({len(attempts)} attempt(s): {', '.join(attempts)})"), None
         else:
-            error_msg = result.stderr
             # Check for common cookie-related errors
             if 'cookies' in error_msg.lower() or 'sign in' in error_msg.lower() or 'bot' in error_msg.lower():
                 if use_cookies:
                     error_msg += " (Cookies may be expired or invalid. Try refreshing them.)"
                 else:
                     error_msg += " (Cookies file not found. Export cookies from your browser.)"
-            return False, error_msg
-    except subprocess.TimeoutExpired:
-        return False, "Download timeout"
+            return False, error_msg, None
     except FileNotFoundError:
-        return False, "yt-dlp not found. Please install it: pip install yt-dlp"
+        return False, "yt-dlp not found. Please install it: pip install yt-dlp", None
     except Exception as e:
-        return False, str(e)
+        return False, str(e), None
+
+
+# Metadata from /validate is reused by /download for this long
+INFO_CACHE_TTL_SECONDS = int(os.getenv('INFO_CACHE_TTL_SECONDS', '900'))
+INFO_CACHE_MAX_ENTRIES = 500
+
+# Links longer than this are rejected by /validate (index.html promises max ~100MB per file)
+MAX_DURATION_SECONDS = int(os.getenv('MAX_DURATION_SECONDS', '7200'))
+
+# Seconds a metadata-only extraction may take
+METADATA_TIMEOUT = 60
+
+
+class TTLCache:
+    """Small thread-safe dict whose entries expire after a fixed time"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (expires_at, value), in insertion order
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            # Drop the oldest entries once over the limit
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+INFO_CACHE = TTLCache(INFO_CACHE_TTL_SECONDS, INFO_CACHE_MAX_ENTRIES)
+
+# Finished audio files are kept here, keyed by extractor + media id + format
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', os.path.join(DATA_DIR, 'audio-cache'))
+AUDIO_CACHE_MAX_BYTES = int(
+    os.getenv('AUDIO_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+AUDIO_CACHE_FORMAT = 'm4a'
+# Temp files of an insert left this long are from a process that died mid-copy
+AUDIO_CACHE_TMP_MAX_AGE_SECONDS = 3600
+
+
+class AudioCache:
+    """On-disk LRU cache of finished audio files within a byte budget"""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = {}  # digest -> {'name', 'size', 'last_access'}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha256('\x00'.join(key).encode('utf-8')).hexdigest()
+
+    def _paths(self, digest):
+        base = os.path.join(self.cache_dir, digest)
+        return base + '.audio', base + '.json'
+
+    def _load(self):
+        """Rebuild the index from disk, dropping stale leftovers of interrupted inserts"""
+        for item in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, item)
+            if item.endswith('.tmp'):
+                # Another worker process may still be writing it
+                try:
+                    if time.time() - os.path.getmtime(path) > AUDIO_CACHE_TMP_MAX_AGE_SECONDS:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not item.endswith('.json'):
+                continue
+            digest = item[:-len('.json')]
+            audio_path, meta_path = self._paths(digest)
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                stat = os.stat(audio_path)
+            except (OSError, ValueError):
+                for leftover in (audio_path, meta_path):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                continue
+            self._entries[digest] = {'name': meta['name'], 'title': meta.get('title'),
+                                     'size': stat.st_size, 'last_access': stat.st_mtime}
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self._entries.values())
+
+    def contains(self, key):
+        with self._lock:
+            return self._digest(key) in self._entries
+
+    def fetch(self, key, output_dir):
+        """Place the cached file for key into output_dir.
+
+        Returns {'filepath', 'title'} for the placed file, or None on a miss.
+        """
+        digest = self._digest(key)
+        with self._lock:
+            entry = self._entries.get(digest)
+        audio_path, _ = self._paths(digest)
+        target = os.path.join(output_dir, entry['name']) if entry else None
+        if entry is not None:
+            try:
+                # Hard links are free when the cache and downloads share a filesystem
+                try:
+                    os.link(audio_path, target)
+                except OSError:
+                    shutil.copyfile(audio_path, target)
+                os.utime(audio_path)
+            except OSError:
+                # Evicted between the lookup and the link - treat it as a miss
+                target = None
+
+        with self._lock:
+            if target is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['last_access'] = time.time()
+        return {'filepath': target, 'title': entry['title']}
+
+    def store(self, key, file_path, title=None):
+        """Copy a finished file into the cache, then evict least recently used entries"""
+        if not os.path.isfile(file_path) or not file_path.endswith('.' + key[2]):
+            return
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            return
+        digest = self._digest(key)
+        audio_path, meta_path = self._paths(digest)
+        tmp_paths = []
+        try:
+            # Write to unique temp names and rename, so readers never see a partial
+            # file and concurrent inserts (from any worker process) can't mix
+            fd, tmp_audio = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            os.close(fd)
+            tmp_paths.append(tmp_audio)
+            shutil.copyfile(file_path, tmp_audio)
+            fd, tmp_meta = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            tmp_paths.append(tmp_meta)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'name': os.path.basename(file_path), 'title': title,
+                           'key': list(key)}, f)
+            os.replace(tmp_audio, audio_path)
+            os.replace(tmp_meta, meta_path)
+        except OSError as e:
+            print(f"Warning: Could not add {file_path} to audio cache: {e}")
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            return
+        with self._lock:
+            self._entries[digest] = {'name': os.path.basename(file_path), 'title': title,
+                                     'size': size, 'last_access': time.time()}
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes() > self.max_bytes and self._entries:
+            digest = min(self._entries,
+                         key=lambda d: self._entries[d]['last_access'])
+            self._entries.pop(digest)
+            for path in self._paths(digest):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.total_bytes(),
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+AUDIO_CACHE = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+
+# Unfinished yt-dlp downloads (.part files) are kept here, one directory per media
+PARTIAL_DIR = os.getenv('PARTIAL_DIR', os.path.join(DATA_DIR, 'partial-downloads'))
+# Partial downloads nobody has retried for this long are deleted by the janitor
+PARTIAL_MAX_AGE_SECONDS = int(os.getenv('PARTIAL_MAX_AGE_SECONDS', '86400'))
+
+
+class PartialDownloads:
+    """Stable per-media temp directories, so retries and restarts resume .part files.
+
+    yt-dlp downloads into the directory (its temp path) and only moves the
+    finished file out, so an attempt that fails or is cut off leaves its
+    .part behind for the next attempt, request or server process, which
+    continues it with a range request. A flock on each directory keeps two
+    attempts, in any worker process, from writing the same file, and a
+    stamp of the format being downloaded keeps an attempt that picked a
+    different format from appending to another stream's bytes.
+    """
+
+    LOCK_NAME = '.lock'
+    FORMAT_NAME = '.format'
+
+    def __init__(self, root, max_age):
+        self.root = root
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._held = {}  # path -> open lock file
+        self.resumed = 0
+        self.removed = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def _try_lock(path):
+        """Open and flock path's lock file, or return None if someone holds it"""
+        try:
+            lock_file = open(os.path.join(path, PartialDownloads.LOCK_NAME), 'a')
+        except OSError:
+            return None
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def acquire(self, key):
+        """Return the directory for key's partial files, or None while another attempt uses it"""
+        path = os.path.join(self.root, self._digest(key))
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError:
+            return None
+        lock_file = self._try_lock(path)
+        if lock_file is None:
+            return None
+        if set(os.listdir(path)) - {self.LOCK_NAME, self.FORMAT_NAME}:
+            print(f"Resuming partial download in {os.path.basename(path)}")
+            with self._lock:
+                self.resumed += 1
+        os.utime(path)
+        with self._lock:
+            self._held[path] = lock_file
+        return path
+
+    @staticmethod
+    def format_stamp(format_id, filesize):
+        return f"{format_id} {filesize or ''}"
+
+    def match_format(self, path, format_id, filesize):
+        """Right before yt-dlp downloads into path, drop partial files of a different format.
+
+        Called with the lock held, once the format is chosen.
+        """
+        stamp = self.format_stamp(format_id, filesize)
+        stamp_path = os.path.join(path, self.FORMAT_NAME)
+        try:
+            with open(stamp_path) as f:
+                if f.read() == stamp:
+                    return
+        except OSError:
+            pass
+        stale = [name for name in os.listdir(path) if name not in (self.LOCK_NAME, self.FORMAT_NAME)]
+        if stale:
+            print(f"Discarding partial download in {os.path.basename(path)}: format is now {format_id}")
+        for name in stale:
+            os.remove(os.path.join(path, name))
+        with open(stamp_path, 'w') as f:
+            f.write(stamp)
+
+    @classmethod
+    def match_format_command(cls, path):
+        """match_format() as a shell command for the yt-dlp executable's --exec before_dl:"""
+        # An output template: %% is a literal % and %(...)q a shell-quoted field
+        directory = shlex.quote(path).replace('%', '%%')
+        return (f"cd {directory} && stamp=$(printf '%%s %%s' %(format_id)q %(filesize|)q) && "
+                f"if [ \"$(cat {cls.FORMAT_NAME} 2>/dev/null)\" != \"$stamp\" ]; then "
+                f"find . -maxdepth 1 -type f ! -name {cls.LOCK_NAME} -delete && "
+                f"printf '%%s' \"$stamp\" > {cls.FORMAT_NAME}; fi")
+
+    def release(self, path):
+        """Unlock path; it's removed if the download left nothing to resume"""
+        with self._lock:
+            lock_file = self._held.pop(path, None)
+        try:
+            if set(os.listdir(path)) <= {self.LOCK_NAME, self.FORMAT_NAME}:
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.utime(path)  # Age counts from the last attempt
+        except OSError:
+            pass
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def sweep(self):
+        """Delete partial downloads no attempt has touched for max_age"""
+        now = time.time()
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.stat(path).st_mtime <= self.max_age:
+                    continue
+            except OSError:
+                continue
+            if os.path.isdir(path):
+                lock_file = self._try_lock(path)
+                if lock_file is None:
+                    continue  # Being resumed right now
+                shutil.rmtree(path, ignore_errors=True)
+                lock_file.close()
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+            with self._lock:
+                self.removed += 1
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] Removed stale partial download {name}")
+
+    def stats(self):
+        try:
+            entries = len(os.listdir(self.root))
+        except OSError:
+            entries = 0
+        with self._lock:
+            return {'entries': entries, 'in_use': len(self._held),
+                    'bytes': directory_size(self.root), 'max_age_seconds': self.max_age,
+                    'resumed': self.resumed, 'removed': self.removed}
+
+
+PARTIAL_DOWNLOADS = PartialDownloads(PARTIAL_DIR, PARTIAL_MAX_AGE_SECONDS)
+
 
+def media_cache_key(url):
+    """(extractor, media id, format) for a URL, or None if it can't be known before downloading"""
+    key = media_key(url)
+    return (*key, AUDIO_CACHE_FORMAT) if key else None
 
-# Track active downloads
-ACTIVE_DOWNLOADS = set()
-DOWNLOAD_LOCK_FILE = os.path.join(
-    os.path.dirname(__file__), '.download_in_progress')
+
+# Metadata extraction is network-bound and light, so it gets its own small pool
+# instead of queueing behind downloads in DOWNLOAD_SCHEDULER
+VALIDATION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix='validate')
+
+
+def extract_metadata(url, use_cookies):
+    """Extract metadata for a URL without downloading, returning (info, error_text)"""
+    if 'youtube' in url.lower():
+        strategy = STRATEGY_STATS.ordered(YOUTUBE_STRATEGIES)[0]
+    else:
+        strategy = STANDARD_STRATEGY
+
+    try:
+        if DOWNLOAD_ENGINE == 'inprocess':
+            ydl = get_youtube_dl(strategy, use_cookies)
+            # DeadlineYoutubeDL caps each request, and gives up, at this deadline
+            _ENGINE_LOCAL.deadline = time.time() + METADATA_TIMEOUT
+            try:
+                info = ydl.extract_info(url, download=False, process=False)
+            except DownloadCancelled:
+                return None, "Timed out while checking the link"
+            finally:
+                _ENGINE_LOCAL.deadline = None
+            if info.get('_type') in ('playlist', 'multi_video'):
+                return {'_type': 'playlist', 'title': info.get('title')}, None
+            return ydl.sanitize_info(info), None
+
+        yt_dlp_path = TOOLS.yt_dlp_path()
+        if not yt_dlp_path:
+            return None, "yt-dlp not found. Please install it: pip install yt-dlp"
+        cmd = [yt_dlp_path, '--dump-single-json', '--flat-playlist'] + \
+            build_cli_args(strategy, url, DOWNLOAD_DIR, use_cookies)
+        result = subprocess.run(
+            cmd,
+            capture_output=True,
+            text=True,
+            timeout=METADATA_TIMEOUT
+        )
+        if result.returncode != 0:
+            return None, result.stderr
+        return json.loads(result.stdout), None
+    except subprocess.TimeoutExpired:
+        return None, "Timed out while checking the link"
+    except Exception as e:
+        return None, str(e)
+
+
+def rejection_reason(info, error_msg):
+    """Why a link can't be downloaded, or None if it looks fine"""
+    if info is None:
+        lowered = (error_msg or '').lower()
+        if 'private' in lowered:
+            return 'Video is private'
+        if 'unavailable' in lowered or 'not available' in lowered or '404' in lowered:
+            return 'Video is unavailable'
+        if 'sign in' in lowered or 'bot' in lowered:
+            return 'Sign-in required (cookies may be expired)'
+        if 'timed out' in lowered:
+            return 'Timed out while checking the link'
+        return (error_msg or 'Could not read link').strip()[:200]
+
+    if info.get('_type') == 'playlist':
+        return None  # Expanded into its entries when downloaded
+    if info.get('is_live') or info.get('live_status') in ('is_live', 'is_upcoming'):
+        return 'Live streams are not supported'
+    duration = info.get('duration')
+    if duration and duration > MAX_DURATION_SECONDS:
+        return f'Too long ({int(duration // 60)} min, max {MAX_DURATION_SECONDS // 60} min)'
+    return None
+
+
+# Upper bound on links in one job, counting entries expanded from playlists
+MAX_LINKS_PER_JOB = int(os.getenv('MAX_LINKS_PER_JOB', '500'))
+
+
+class InvalidLinksError(ValueError):
+    """Raised when a request's links aren't in a shape get_request_links() accepts"""
+
+
+def get_request_links():
+    """Return (submitted_url, canonical_url) pairs from the request, without duplicates.
+
+    Accepts a JSON body {"urls": [...]} or the page's link-1, link-2, ... form fields.
+    Links naming the same media (e.g. a youtu.be and a youtube.com link) are kept once.
+    """
+    if request.is_json:
+        body = request.get_json(silent=True)
+        submitted = body.get('urls') if isinstance(body, dict) else None
+        if not isinstance(submitted, list):
+            raise InvalidLinksError('Expected a JSON object with a "urls" list')
+        submitted = [u for u in submitted if isinstance(u, str)]
+    else:
+        link_keys = [k for k in request.form if k.startswith(
+            'link-') and k[len('link-'):].isdigit()]
+        link_keys.sort(key=lambda k: int(k[len('link-'):]))
+        submitted = [request.form[k] for k in link_keys]
+
+    links = []
+    seen = set()
+    for url in submitted:
+        url = url.strip()
+        if not url:
+            continue
+        canonical = canonical_url(url)
+        key = link_key(canonical)
+        if key in seen:
+            print(f"Skipping duplicate link: {url}")
+            continue
+        seen.add(key)
+        links.append((url, canonical))
+        if len(links) >= MAX_LINKS_PER_JOB:
+            break
+    return links
+
+
+def get_request_option(name):
+    """A request option from the JSON body or the form"""
+    if request.is_json:
+        body = request.get_json(silent=True)
+        return body.get(name) if isinstance(body, dict) else None
+    return request.form.get(name)
+
+
+def looks_like_playlist(url):
+    """True for playlist, album and channel URLs that should be expanded into their entries"""
+    info = INFO_CACHE.get(url)
+    if info is not None:
+        return info.get('_type') == 'playlist'
+
+    parsed = urlparse(url)
+    host = host_key(url)
+    path = parsed.path
+    if host == 'youtube.com':
+        if path == '/playlist' and 'list=' in parsed.query:
+            return True
+        return path.startswith(('/channel/', '/c/', '/user/', '/@'))
+    if host == 'soundcloud.com':
+        return '/sets/' in path
+    if host.endswith('bandcamp.com'):
+        return path.startswith('/album/')
+    return False
+
+
+def iter_playlist_entries(url, use_cookies, depth=0):
+    """Yield the entry URLs of a playlist or channel as they're discovered.
+
+    Uses flat extraction, so each page of a long listing is fetched only when
+    the previous entries have been handed out - downloads start right away.
+    """
+    if DOWNLOAD_ENGINE == 'inprocess':
+        opts = {'quiet': True, 'no_warnings': True,
+                'extract_flat': 'in_playlist', 'lazy_playlist': True}
+        if use_cookies:
+            opts['cookiefile'] = COOKIES_FILE
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+            for entry in info.get('entries') or ():
+                entry_url = (entry or {}).get('url') or (entry or {}).get('webpage_url')
+                if not entry_url:
+                    continue
+                # Channel pages list their tabs as nested playlists
+                if entry.get('_type') == 'playlist' or (depth == 0 and looks_like_playlist(entry_url)):
+                    if depth == 0:
+                        yield from iter_playlist_entries(entry_url, use_cookies, depth + 1)
+                    continue
+                yield entry_url
+        return
+
+    yt_dlp_path = TOOLS.yt_dlp_path()
+    if not yt_dlp_path:
+        raise FileNotFoundError('yt-dlp not found')
+    cmd = [yt_dlp_path, '--flat-playlist', '--lazy-playlist', '--no-warnings',
+           '--print', 'url']
+    if use_cookies:
+        cmd += ['--cookies', COOKIES_FILE]
+    process = subprocess.Popen(cmd + [url], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, text=True, bufsize=1)
+    try:
+        for line in process.stdout:
+            entry_url = line.strip()
+            if entry_url and entry_url != 'NA':
+                yield entry_url
+        if process.wait() != 0 and process.returncode is not None:
+            error = process.stderr.read().strip()
+            if error:
+                raise RuntimeError(error[:200])
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
 
 
 @app.route('/')
@@ -298,45 +1897,79 @@ def index():
 def status():
     """Check if downloads are in progress - safe to restart service"""
     try:
-        # Check if lock file exists (indicates download in progress)
-        has_lock_file = os.path.exists(DOWNLOAD_LOCK_FILE)
-
-        # Check if downloads directory has recent activity (within last 5 minutes)
-        recent_activity = False
-        if os.path.exists(DOWNLOAD_DIR):
-            try:
-                # Check for directories modified in last 5 minutes
-                current_time = time.time()
-                for item in os.listdir(DOWNLOAD_DIR):
-                    item_path = os.path.join(DOWNLOAD_DIR, item)
-                    if os.path.isdir(item_path):
-                        # Check modification time
-                        mtime = os.path.getmtime(item_path)
-                        if current_time - mtime < 300:  # 5 minutes
-                            recent_activity = True
-                            break
-            except Exception:
-                pass
-
-        is_busy = has_lock_file or recent_activity or len(ACTIVE_DOWNLOADS) > 0
+        drain_state = DRAIN.stats()
+        active_jobs = drain_state['remaining']['jobs']
 
         return jsonify({
-            'status': 'busy' if is_busy else 'idle',
-            'active_downloads': len(ACTIVE_DOWNLOADS),
-            'has_lock_file': has_lock_file,
-            'recent_activity': recent_activity,
-            'safe_to_restart': not is_busy
+            'status': 'busy' if active_jobs else 'idle',
+            'active_downloads': active_jobs,
+            'safe_to_restart': drain_state['safe_to_restart'],
+            'drain': drain_state,
+            'scheduler': DOWNLOAD_SCHEDULER.stats(),
+            'admission': DOWNLOAD_ADMISSION.stats(),
+            'fragments': FRAGMENT_BUDGET.stats(),
+            'tools': TOOLS.describe(),
+            'strategies': STRATEGY_STATS.snapshot(),
+            'info_cache': INFO_CACHE.stats(),
+            'audio_cache': AUDIO_CACHE.stats(),
+            'download_flights': DOWNLOAD_FLIGHTS.stats(),
+            'partial_downloads': PARTIAL_DOWNLOADS.stats(),
+            'janitor': JANITOR.stats()
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def cache_hit_ratio(stats):
+    lookups = stats['hits'] + stats['misses']
+    return round(stats['hits'] / lookups, 4) if lookups else 0
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Counters and latency histograms in the Prometheus text format"""
+    scheduler = DOWNLOAD_SCHEDULER.stats()
+    try:
+        cookies_age = round(time.time() - os.path.getmtime(COOKIES_FILE))
+    except OSError:
+        cookies_age = -1
+
+    samples = [
+        ('linkdl_queue_depth', {}, scheduler['queue_depth']),
+        ('linkdl_active_workers', {}, scheduler['active_workers']),
+        ('linkdl_fragment_connections', {}, FRAGMENT_BUDGET.stats()['in_use']),
+        ('linkdl_cache_hit_ratio', {'cache': 'info'},
+         cache_hit_ratio(INFO_CACHE.stats())),
+        ('linkdl_cache_hit_ratio', {'cache': 'audio'},
+         cache_hit_ratio(AUDIO_CACHE.stats())),
+        ('linkdl_cookies_age_seconds', {}, cookies_age),
+        ('linkdl_download_dir_bytes', {}, JANITOR.stats()['bytes']),
+    ]
+    # StrategyStats already keeps lifetime totals, so they're read at scrape time
+    strategies = sorted(STRATEGY_STATS.snapshot().items())
+    samples += [('linkdl_strategy_attempts_total', {'strategy': name}, strategy['attempts'])
+                for name, strategy in strategies]
+    samples += [('linkdl_strategy_successes_total', {'strategy': name}, strategy['successes'])
+                for name, strategy in strategies]
+
+    return Response(METRICS.render(samples),
+                    mimetype='text/plain; version=0.0.4')
+
+
+# What serve_static() may send: these directories, plus these files from the app directory
+STATIC_DIRS = ('css', 'js', 'img')
+STATIC_ROOT_FILES = ('index.html', 'manifest.webmanifest')
+
+
 @app.route('/<path:path>')
 def serve_static(path):
     """Serve static files (CSS, JS, images)"""
     # Security: prevent directory traversal
     if '..' in path or path.startswith('/'):
         return "Not found", 404
+    # Only the site's own assets - never app code, cookies or runtime data
+    if path.split('/', 1)[0] not in STATIC_DIRS and path not in STATIC_ROOT_FILES:
+        return "Not found", 404
 
     file_path = os.path.join(os.path.dirname(__file__), path)
     if os.path.exists(file_path) and os.path.isfile(file_path):
@@ -344,106 +1977,1119 @@ def serve_static(path):
     return "Not found", 404
 
 
-@app.route('/download', methods=['POST'])
-# @limiter.limit("5 per minute")  # Uncomment to enable rate limiting
-def download():
-    """Handle the download request"""
-    session_dir = None
-    try:
-        # Get all links from the form
-        links = []
-        for i in range(1, 11):
-            link_key = f'link-{i}'
-            if link_key in request.form:
-                url = request.form[link_key].strip()
-                if url:
-                    # Clean YouTube URLs to remove extra query parameters
-                    url = clean_youtube_url(url)
-                    links.append(url)
+# Finished archives are kept this long after their last fetch so the browser (or a retry) can get them
+RESULT_RETENTION_SECONDS = int(os.getenv('RESULT_RETENTION_SECONDS', '3600'))
+# Finished jobs are evicted early, least recently used first, once downloads/ grows past this
+DOWNLOAD_QUOTA_BYTES = int(os.getenv('DOWNLOAD_QUOTA_MB', '2048')) * 1024 * 1024
+# How often the janitor sweeps downloads/ (it's also woken whenever a job finishes)
+JANITOR_INTERVAL_SECONDS = int(os.getenv('JANITOR_INTERVAL_SECONDS', '60'))
 
-        print(f"Received {len(links)} links to download")
+# Parallel download configuration
+# Each download uses ~64KB buffer + process overhead (~50-100MB per download)
+# This cap is process-wide: every request shares the same DOWNLOAD_SCHEDULER.
+# It's only a ceiling - AdmissionController starts a download only when there's
+# memory for it, so the real parallelism follows what the box can take.
+MAX_PARALLEL_DOWNLOADS = int(os.getenv('MAX_PARALLEL_DOWNLOADS', '8'))
 
-        if not links:
-            return jsonify({'error': 'No links provided'}), 400
+# Memory that must stay free after starting another download
+ADMISSION_MIN_FREE_MB = int(os.getenv('ADMISSION_MIN_FREE_MB', '150'))
 
-        # Create a temporary directory for this download session
-        session_dir = tempfile.mkdtemp(dir=DOWNLOAD_DIR)
+# Assumed footprint of one download until real ones have been measured
+ADMISSION_DEFAULT_ESTIMATE_MB = 100
 
-        # Create lock file to indicate download in progress
-        try:
-            with open(DOWNLOAD_LOCK_FILE, 'w') as f:
-                f.write(str(time.time()))
-        except Exception:
-            pass  # Non-critical, continue anyway
+# Downloads younger than this haven't reached full size yet, so their
+# estimated footprint is reserved on top of what /proc/meminfo shows
+ADMISSION_WARMUP_SECONDS = 10
 
-        # Track this download session
-        ACTIVE_DOWNLOADS.add(session_dir)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
 
-        # Download all links in parallel
-        errors = []
 
-        # Track files before download
-        files_before = set(os.listdir(session_dir))
+def read_mem_available():
+    """MemAvailable from /proc/meminfo in bytes, or None when not on Linux"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def descendant_rss(root_pid):
+    """Total resident memory of every process below root_pid (yt-dlp, ffmpeg, ...)"""
+    children = {}
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # The command name may contain spaces, so split after its closing paren
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(pid)
+        except (OSError, ValueError, IndexError):
+            continue
+
+    total = 0
+    pending = list(children.get(root_pid, []))
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+class AdmissionController:
+    """Decides whether there's enough free memory to start one more download"""
+
+    def __init__(self, min_free_bytes, default_estimate_bytes, warmup_seconds):
+        self.min_free_bytes = min_free_bytes
+        self.estimate_bytes = default_estimate_bytes
+        self.min_estimate_bytes = default_estimate_bytes // 2
+        self.warmup_seconds = warmup_seconds
+        self._lock = threading.Lock()
+        self._recent_starts = deque()
+        self.admitted = 0
+        self.deferred = 0
+        self.last_decision = None
+
+    def try_admit(self, active):
+        """Return True (and count the start) if a new download fits in memory right now"""
+        with self._lock:
+            now = time.time()
+            while self._recent_starts and now - self._recent_starts[0] > self.warmup_seconds:
+                self._recent_starts.popleft()
+
+            available = read_mem_available()
+            in_flight_rss = descendant_rss(os.getpid())
+            if active > 0 and in_flight_rss > 0:
+                # Smoothed per-download footprint from what's running now
+                measured = in_flight_rss / active
+                # (floored, since in-process yt-dlp memory isn't in any child process)
+                self.estimate_bytes = max(int(0.8 * self.estimate_bytes + 0.2 * measured),
+                                          self.min_estimate_bytes)
+
+            warming_up = len(self._recent_starts)
+            if available is None:
+                admit, reason = True, 'no /proc/meminfo - only the worker cap applies'
+                headroom = None
+            else:
+                headroom = available - warming_up * self.estimate_bytes - self.estimate_bytes
+                if active == 0:
+                    # Never stall completely - one download at a time always runs
+                    admit, reason = True, 'nothing running'
+                elif headroom >= self.min_free_bytes:
+                    admit, reason = True, 'enough memory'
+                else:
+                    admit, reason = False, 'not enough memory'
+
+            self.last_decision = {
+                'at': now,
+                'admitted': admit,
+                'reason': reason,
+                'active': active,
+                'mem_available_mb': round(available / 1048576) if available is not None else None,
+                'in_flight_rss_mb': round(in_flight_rss / 1048576),
+                'warming_up': warming_up,
+                'headroom_mb': round(headroom / 1048576) if headroom is not None else None,
+            }
+            if admit:
+                self.admitted += 1
+                self._recent_starts.append(now)
+            else:
+                self.deferred += 1
+            return admit
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_free_mb': round(self.min_free_bytes / 1048576),
+                'estimate_per_download_mb': round(self.estimate_bytes / 1048576),
+                'admitted': self.admitted,
+                'deferred': self.deferred,
+                'last_decision': self.last_decision,
+            }
+
+
+DOWNLOAD_ADMISSION = AdmissionController(
+    ADMISSION_MIN_FREE_MB * 1048576,
+    ADMISSION_DEFAULT_ESTIMATE_MB * 1048576,
+    ADMISSION_WARMUP_SECONDS)
+
+# Extra fragment connections shared by all running downloads. Each download
+# always has its own connection (it holds a scheduler worker); only the ones
+# past the first are drawn from here, so fragments can't multiply the
+# MAX_PARALLEL_DOWNLOADS ceiling beyond this.
+MAX_FRAGMENT_CONNECTIONS = int(os.getenv('MAX_FRAGMENT_CONNECTIONS', str(MAX_PARALLEL_DOWNLOADS * 2)))
+
+
+class FragmentBudget:
+    """Hands out extra fragment connections while the shared pool and free memory allow"""
+
+    def __init__(self, capacity, bytes_per_connection, min_free_bytes):
+        self.capacity = capacity
+        self.bytes_per_connection = bytes_per_connection
+        self.min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self.granted = 0
+        self.denied = 0
+
+    def acquire(self, wanted):
+        """Return how many connections (1..wanted) a download may open; release() them after"""
+        with self._lock:
+            extra = max(0, min(wanted - 1, self.capacity - self._in_use))
+            available = read_mem_available()
+            if available is not None:
+                # Already granted connections are in MemAvailable once they're running,
+                # so only the new ones have to fit in the headroom
+                affordable = (available - self.min_free_bytes) // self.bytes_per_connection
+                extra = max(0, min(extra, affordable))
+            self._in_use += extra
+            self.granted += extra
+            self.denied += max(0, wanted - 1 - extra)
+            return 1 + extra
+
+    def release(self, connections):
+        with self._lock:
+            self._in_use -= connections - 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'per_download': FRAGMENT_CONCURRENCY,
+                'capacity': self.capacity,
+                'in_use': self._in_use,
+                'granted': self.granted,
+                'denied': self.denied,
+                'external_downloader': EXTERNAL_DOWNLOADER or None,
+            }
+
+
+FRAGMENT_BUDGET = FragmentBudget(
+    MAX_FRAGMENT_CONNECTIONS,
+    FRAGMENT_MEMORY_MB * 1048576,
+    ADMISSION_MIN_FREE_MB * 1048576)
+
+# Links waiting for a worker beyond this are refused with 503 instead of piling up
+MAX_QUEUED_DOWNLOADS = int(os.getenv('MAX_QUEUED_DOWNLOADS', '50'))
+# Links one job may have queued or running at once; the rest are fed in as these
+# finish, so a big batch or playlist can't fill the queue and lock other users out
+MAX_LINKS_IN_FLIGHT_PER_JOB = int(os.getenv(
+    'MAX_LINKS_IN_FLIGHT_PER_JOB', str(max(MAX_PARALLEL_DOWNLOADS, MAX_QUEUED_DOWNLOADS // 4))))
+
+
+# Per-host limits, so a burst of links for one site doesn't trip its bot
+# detection while other sites sit idle. JSON object keyed by host, e.g.
+# {"youtube.com": {"concurrency": 2, "rate": 0.5, "burst": 3}}
+# concurrency: downloads running at once; rate/burst: token bucket of
+# download starts per second. Hosts not listed only share the global caps.
+DEFAULT_HOST_LIMITS = {
+    'youtube.com': {'concurrency': 3, 'rate': 0.5, 'burst': 3},
+}
+HOST_LIMITS = dict(DEFAULT_HOST_LIMITS, **json.loads(os.getenv('HOST_LIMITS', '{}')))
+
+
+def host_key(url):
+    """The site a URL belongs to, with common subdomains and short links folded together"""
+    host = (urlparse(url).hostname or '').lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if host in ('youtu.be', 'youtube-nocookie.com'):
+        host = 'youtube.com'
+    return host
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def seconds_until_token(self):
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class SchedulerFullError(Exception):
+    """Raised when the download queue has no room for more work"""
+
+
+class DownloadScheduler:
+    """Fixed pool of worker threads fed from one bounded queue, shared by all requests.
+
+    Workers take the oldest queued item whose host is under its concurrency
+    cap and has a rate token, so a saturated host only delays its own links.
+    """
+
+    def __init__(self, max_workers, max_queued, admission=None, host_limits=None, max_hedges=0):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_hedges = max_hedges
+        self.admission = admission
+        self.host_limits = host_limits or {}
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # Serializes admission checks so two workers can't both claim the same headroom
+        self._admission_lock = threading.Lock()
+        self._workers = []
+        self._active = 0
+        self._busy = 0  # Workers holding an item, admitted or not
+        self._hedges = 0  # Backup attempts holding a worker slot (see try_start_hedge)
+        self._hedges_started = 0
+        self._waiting_for_memory = 0
+        self._host_active = {}
+        self._host_buckets = {host: TokenBucket(limits['rate'], limits.get('burst', 1))
+                              for host, limits in self.host_limits.items() if limits.get('rate')}
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._recent_waits = deque(maxlen=100)
+        # Paused while draining in checkpoint mode: running items finish, queued ones stay put
+        self._paused = False
+
+    def pause(self):
+        with self._lock:
+            self._paused = True
+
+    def resume(self):
+        with self._changed:
+            self._paused = False
+            self._changed.notify_all()
+
+    def _ensure_workers(self):
+        with self._lock:
+            while len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._worker_loop, daemon=True,
+                                          name=f'download-worker-{len(self._workers) + 1}')
+                worker.start()
+                self._workers.append(worker)
+
+    def free_slots(self):
+        """How many more links the queue accepts right now"""
+        with self._lock:
+            return self.max_queued - len(self._queue)
+
+    def submit(self, fn, *args, host='', block=False):
+        """Queue fn(*args) and return a Future for its result.
+
+        With block=True, wait for room in the queue instead of raising SchedulerFullError.
+        """
+        self._ensure_workers()
+        future = Future()
+        with self._changed:
+            while len(self._queue) >= self.max_queued:
+                if not block:
+                    self._rejected += 1
+                    raise SchedulerFullError(
+                        f'Download queue is full ({self.max_queued} waiting)')
+                self._changed.wait()
+            self._queue.append((time.time(), host, future, fn, args))
+            self._submitted += 1
+            self._changed.notify()
+        return future
+
+    def _take_ready(self):
+        """Pop the oldest item its host allows to start now (call with the lock held).
+
+        Returns (item, None), or (None, seconds) to wait before a rate token frees up.
+        """
+        if self._paused:
+            return None, None
+        if self._busy + self._hedges >= self.max_workers:
+            return None, None  # Running hedges have borrowed the idle workers
+        blocked_hosts = set()
+        retry_in = None
+        for item in self._queue:
+            host = item[1]
+            if host in blocked_hosts:
+                continue
+            limits = self.host_limits.get(host, {})
+            if self._host_active.get(host, 0) >= limits.get('concurrency', self.max_workers):
+                blocked_hosts.add(host)
+                continue
+            bucket = self._host_buckets.get(host)
+            if bucket is not None and not bucket.try_take():
+                wait = bucket.seconds_until_token()
+                retry_in = wait if retry_in is None else min(retry_in, wait)
+                blocked_hosts.add(host)
+                continue
+            self._queue.remove(item)
+            self._host_active[host] = self._host_active.get(host, 0) + 1
+            self._busy += 1
+            return item, None
+        return None, retry_in
+
+    def _wait_for_admission(self):
+        if self.admission is None:
+            return
+        with self._lock:
+            self._waiting_for_memory += 1
+        try:
+            with self._admission_lock:
+                while not self.admission.try_admit(self._active):
+                    time.sleep(1)
+        finally:
+            with self._lock:
+                self._waiting_for_memory -= 1
+
+    def _worker_loop(self):
+        while True:
+            with self._changed:
+                while True:
+                    item, retry_in = self._take_ready()
+                    if item is not None:
+                        # Room in the queue for a blocked submit()
+                        self._changed.notify_all()
+                        break
+                    self._changed.wait(timeout=retry_in)
+            enqueued_at, host, future, fn, args = item
 
-        # Parallel download configuration
-        # Use 2-3 workers for 1GB RAM (safe, allows 2-3x speedup)
-        # Each download uses ~64KB buffer + process overhead (~50-100MB per download)
-        MAX_PARALLEL_DOWNLOADS = 4  # 3 is safe for 1GB RAM, have not tested 5
+            try:
+                self._wait_for_admission()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                waited = time.time() - enqueued_at
+                METRICS.observe('linkdl_stage_seconds', waited, stage='queue')
+                with self._lock:
+                    self._active += 1
+                    self._recent_waits.append(waited)
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    with self._lock:
+                        self._active -= 1
+                        self._completed += 1
+            finally:
+                with self._changed:
+                    self._host_active[host] -= 1
+                    self._busy -= 1
+                    # A host slot freed up - another worker may be able to start its link
+                    self._changed.notify_all()
+
+    def try_start_hedge(self, host):
+        """Claim an idle worker slot for a backup attempt, returning False if there's none.
+
+        Hedges only take capacity no queued link is waiting for, count against
+        the host's concurrency and admission like any download, and keep the
+        slot from the workers until end_hedge().
+        """
+        with self._lock:
+            if (self._paused or self._queue or self._hedges >= self.max_hedges
+                    or self._busy + self._hedges >= self.max_workers):
+                return False
+            limits = self.host_limits.get(host, {})
+            if self._host_active.get(host, 0) >= limits.get('concurrency', self.max_workers):
+                return False
+            bucket = self._host_buckets.get(host)
+            if bucket is not None and not bucket.try_take():
+                return False
+            self._hedges += 1
+            self._host_active[host] = self._host_active.get(host, 0) + 1
+            active = self._active
+        if self.admission is not None:
+            with self._admission_lock:
+                admitted = self.admission.try_admit(active + 1)
+            if not admitted:
+                with self._changed:
+                    self._hedges -= 1
+                    self._host_active[host] -= 1
+                    self._changed.notify_all()
+                return False
+        with self._lock:
+            self._active += 1
+            self._hedges_started += 1
+        return True
+
+    def end_hedge(self, host):
+        """Give back a slot claimed by try_start_hedge()"""
+        with self._changed:
+            self._active -= 1
+            self._hedges -= 1
+            self._host_active[host] -= 1
+            self._changed.notify_all()
+
+    def stats(self):
+        with self._lock:
+            waits = list(self._recent_waits)
+            hosts = {}
+            for _, host, _, _, _ in self._queue:
+                hosts.setdefault(host, {'queued': 0})['queued'] += 1
+            for host, active in self._host_active.items():
+                hosts.setdefault(host, {'queued': 0})['active'] = active
+            for host, info in hosts.items():
+                info.setdefault('active', 0)
+                info['limits'] = self.host_limits.get(host)
+            return {
+                'max_workers': self.max_workers,
+                'active_workers': self._active,
+                'hedges': self._hedges,
+                'hedges_started': self._hedges_started,
+                'paused': self._paused,
+                'queue_depth': len(self._queue),
+                'waiting_for_memory': self._waiting_for_memory,
+                'max_queued': self.max_queued,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'avg_wait_seconds': round(sum(waits) / len(waits), 3) if waits else 0.0,
+                'max_wait_seconds': round(max(waits), 3) if waits else 0.0,
+                'hosts': hosts,
+            }
+
+
+# Hedged fallback: when a YouTube strategy hasn't received any bytes after this
+# many seconds, the next strategy starts alongside it and whichever finishes
+# first is kept. 0 (the default) keeps the strictly sequential fallback chain.
+HEDGE_DELAY_SECONDS = float(os.getenv('HEDGE_DELAY_SECONDS', '0'))
+
+# Backup attempts running at once across all links. Each also needs a worker
+# slot nothing queued is waiting for, so hedging never exceeds MAX_PARALLEL_DOWNLOADS.
+MAX_HEDGED_ATTEMPTS = int(os.getenv('MAX_HEDGED_ATTEMPTS',
+                                    str(max(1, MAX_PARALLEL_DOWNLOADS // 4))))
+
+DOWNLOAD_SCHEDULER = DownloadScheduler(
+    MAX_PARALLEL_DOWNLOADS, MAX_QUEUED_DOWNLOADS, DOWNLOAD_ADMISSION, HOST_LIMITS,
+    max_hedges=MAX_HEDGED_ATTEMPTS if HEDGE_DELAY_SECONDS > 0 else 0)
+
+# Backup attempts run here; long-lived threads keep their in-process YoutubeDL instances
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=max(MAX_HEDGED_ATTEMPTS, 1),
+                                    thread_name_prefix='hedge')
+
+
+# Link states that won't change again ('expanded' = a playlist whose entries became links)
+TERMINAL_LINK_STATUSES = ('done', 'failed', 'expanded')
+
+# Minimum seconds between progress wake-ups for one link
+PROGRESS_NOTIFY_INTERVAL = 0.5
+
+# Jobs and their per-link results, shared by every worker process
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join(DATA_DIR, 'jobs.db'))
+# Workers refresh the heartbeat of the jobs they run this often...
+JOB_HEARTBEAT_SECONDS = 15
+# ...and take over queued/running jobs whose owner has been silent this long
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', '60'))
+# How often a job run by another worker is re-read for /jobs/<id>/events and /download_stream
+REMOTE_JOB_POLL_SECONDS = 1.0
+# last_access is written at most this often per job, so polling /jobs/<id> stays read-only
+JOB_TOUCH_INTERVAL = 30
+
+JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    session_dir TEXT NOT NULL,
+    archive_mode TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    zip_path TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    last_access REAL NOT NULL,
+    owner TEXT,
+    heartbeat REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS links (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    parent INTEGER,
+    files TEXT,
+    conversion TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE TABLE IF NOT EXISTS server_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class JobStore:
+    """Durable jobs and per-link results in SQLite (WAL), shared by all worker processes.
+
+    Only state changes are written; live progress stays in memory with the
+    process running the job. Each process heartbeats the jobs it owns, and
+    queued or running jobs whose owner went away are claimed and resumed.
+    """
+
+    JOB_FIELDS = ('status', 'error', 'zip_path',
+                  'started_at', 'finished_at', 'last_access')
+    LINK_FIELDS = ('title', 'status', 'error', 'files', 'conversion')
+    ACTIVE_STATUSES = ('queued', 'running')
+
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self._local = threading.local()
+        self._thread = None
+        db = self._connect()
+        db.executescript(JOB_SCHEMA)
+        # Columns added after a database was first created
+        columns = {row['name']
+                   for row in db.execute('PRAGMA table_info(links)')}
+        if 'conversion' not in columns:
+            db.execute('ALTER TABLE links ADD COLUMN conversion TEXT')
+
+    def _connect(self):
+        """This thread's connection (sqlite3 connections can't be shared between threads)"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _link_row(job_id, index, link):
+        files = link.get('files')
+        return (job_id, index, link['url'], link['title'], link['status'], link['error'],
+                link.get('parent'), json.dumps(files) if files is not None else None,
+                link.get('conversion'))
+
+    def create_job(self, job):
+        now = time.time()
+        db = self._connect()
+        with db:
+            db.execute('INSERT INTO jobs (id, session_dir, archive_mode, status, created_at,'
+                       ' last_access, owner, heartbeat) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (job.id, job.session_dir, job.archive_mode, job.status,
+                        job.created_at, job.last_access, self.owner, now))
+            db.executemany('INSERT INTO links VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [self._link_row(job.id, i, link) for i, link in enumerate(job.links)])
+
+    def add_link(self, job_id, index, link):
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       self._link_row(job_id, index, link))
+
+    def update_link(self, job_id, index, fields):
+        fields = {k: v for k, v in fields.items() if k in self.LINK_FIELDS}
+        if not fields:
+            return
+        if 'files' in fields:
+            fields['files'] = json.dumps(fields['files'])
+        db = self._connect()
+        with db:
+            db.execute(f"UPDATE links SET {', '.join(f'{k} = ?' for k in fields)}"
+                       ' WHERE job_id = ? AND idx = ?', (*fields.values(), job_id, index))
+
+    def update_job(self, job_id, fields):
+        fields = {k: v for k, v in fields.items() if k in self.JOB_FIELDS}
+        if not fields:
+            return
+        db = self._connect()
+        with db:
+            db.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                       (*fields.values(), job_id))
+
+    def touch(self, job_id):
+        """Record a client access (rate-limited per job by JOB_TOUCH_INTERVAL)"""
+        now = time.time()
+        db = self._connect()
+        with db:
+            db.execute('UPDATE jobs SET last_access = ? WHERE id = ? AND last_access < ?',
+                       (now, job_id, now - JOB_TOUCH_INTERVAL))
+
+    def load(self, job_id):
+        """(job row, [link dicts]) or None"""
+        db = self._connect()
+        row = db.execute('SELECT * FROM jobs WHERE id = ?',
+                         (job_id,)).fetchone()
+        if row is None:
+            return None
+        links = []
+        for link in db.execute('SELECT * FROM links WHERE job_id = ? ORDER BY idx', (job_id,)):
+            link = {'url': link['url'], 'title': link['title'], 'status': link['status'],
+                    'error': link['error'], 'parent': link['parent'],
+                    **({'files': json.loads(link['files'])} if link['files'] else {}),
+                    **({'conversion': link['conversion']} if link['conversion'] else {})}
+            links.append(link)
+        return dict(row), links
+
+    def delete(self, job_id):
+        db = self._connect()
+        with db:
+            db.execute('DELETE FROM links WHERE job_id = ?', (job_id,))
+            db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def records(self):
+        """{job id: {'status', 'finished_at', 'last_access'}} for every stored job"""
+        rows = self._connect().execute(
+            'SELECT id, status, finished_at, last_access FROM jobs')
+        return {row['id']: dict(row) for row in rows}
+
+    def get_state(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM server_state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row['value']) if row else None
+
+    def set_state(self, key, value):
+        db = self._connect()
+        with db:
+            if value is None:
+                db.execute('DELETE FROM server_state WHERE key = ?', (key,))
+            else:
+                db.execute('INSERT OR REPLACE INTO server_state VALUES (?, ?)',
+                           (key, json.dumps(value)))
+
+    def remaining_work(self):
+        """Unfinished jobs across all workers, and their links by state"""
+        db = self._connect()
+        remaining = {'jobs': self.active_count(), 'queued': 0,
+                     'downloading': 0, 'expanding': 0}
+        for row in db.execute('SELECT l.status, COUNT(*) AS n FROM links l JOIN jobs j'
+                              ' ON j.id = l.job_id WHERE j.status IN (?, ?)'
+                              ' GROUP BY l.status', self.ACTIVE_STATUSES):
+            if row['status'] in remaining:
+                remaining[row['status']] = row['n']
+        return remaining
+
+    def active_count(self):
+        """Queued or running jobs across all worker processes"""
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', self.ACTIVE_STATUSES).fetchone()[0]
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        db = self._connect()
+        with db:
+            db.executemany('UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ?',
+                           [(time.time(), job_id, self.owner) for job_id in job_ids])
+
+    def _owner_gone(self, owner, heartbeat, now):
+        if heartbeat is None or now - heartbeat > JOB_STALE_SECONDS:
+            return True
+        # Same machine: a dead pid means the owner crashed or was restarted
+        host, _, pid = (owner or '').rsplit(':', 1)[0].rpartition(':')  # host:pid:boot
+        if host == socket.gethostname() and pid.isdigit():
+            if int(pid) == os.getpid():
+                return True  # Our pid, but an earlier process (owner strings differ per boot)
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+            except OSError:
+                pass
+        return False
+
+    def claim_orphans(self):
+        """Take over unfinished jobs whose owner went away, returning their ids"""
+        now = time.time()
+        db = self._connect()
+        rows = db.execute('SELECT id, owner, heartbeat FROM jobs WHERE status IN (?, ?)'
+                          ' AND owner IS NOT ?', (*self.ACTIVE_STATUSES, self.owner)).fetchall()
+        claimed = []
+        for row in rows:
+            if not self._owner_gone(row['owner'], row['heartbeat'], now):
+                continue
+            with db:
+                # Compare-and-set so only one worker wins the job
+                cursor = db.execute('UPDATE jobs SET owner = ?, heartbeat = ? WHERE id = ?'
+                                    ' AND owner IS ? AND heartbeat IS ?',
+                                    (self.owner, now, row['id'], row['owner'], row['heartbeat']))
+            if cursor.rowcount == 1:
+                claimed.append(row['id'])
+        return claimed
+
+    def start(self, owned_ids, resume, accepting=lambda: True):
+        """Resume orphaned jobs now, then keep heartbeating and watching for more.
+
+        owned_ids() lists the unfinished jobs this process runs; resume(job_id)
+        restarts a claimed job. Nothing is claimed while accepting() is false.
+        """
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.heartbeat(owned_ids())
+                    if accepting():
+                        for job_id in self.claim_orphans():
+                            resume(job_id)
+                except Exception as e:
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Job store heartbeat failed: {e}")
+                time.sleep(JOB_HEARTBEAT_SECONDS)
+
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+
+
+# host:pid:boot - the random part keeps a restarted process that got its
+# predecessor's pid (PID 1 in a container) from mistaking old jobs for its own
+JOB_STORE = JobStore(JOB_DB_PATH, f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}')
+
+
+class DownloadJob:
+    """State of one /download batch, shared between the request and worker threads"""
+
+    def __init__(self, job_id, session_dir, links, archive_mode='file', store=None):
+        self.id = job_id
+        self.session_dir = session_dir
+        # 'file' builds downloads.zip on disk, 'stream' only serves /download_stream
+        self.archive_mode = archive_mode
+        self.status = 'queued'
+        self.error = None
+        self.zip_path = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Retention counts from the last time a client looked at the job
+        self.last_access = self.created_at
+        # /download_stream clients still reading files; the janitor leaves the job alone meanwhile
+        self.readers = 0
+        self.lock = threading.Lock()
+        # Notified whenever a link or the job changes state
+        self.changed = threading.Condition(self.lock)
+        self.links = []
+        # Bumped on every change; SSE readers send whatever moved since their last version
+        self.version = 0
+        self._link_versions = []
+        self._last_notify = []
+        # Set once the job is persisted; state changes are then written through
+        self.store = None
+        # True for a read-only copy of a job another worker process is running
+        self.remote = False
+        self._touched_at = self.created_at
+        for url in links:
+            self.add_link(url)
+        if store is not None:
+            store.create_job(self)
+            self.store = store
+
+    @classmethod
+    def from_store(cls, store, job_id, remote=True):
+        """Rebuild a job from the store: a read-only copy, or (remote=False) one to resume"""
+        record = store.load(job_id)
+        if record is None:
+            return None
+        row, links = record
+        job = cls(job_id, row['session_dir'], [], row['archive_mode'])
+        job.created_at = row['created_at']
+        job._touched_at = row['last_access']
+        with job.changed:
+            job._apply(row, links)
+        job.remote = remote
+        if not remote:
+            job.store = store
+        return job
+
+    def _apply(self, row, links):
+        """Take job and link state read from the store, bumping whatever changed - call with the lock held"""
+        for name in ('status', 'error', 'zip_path', 'started_at', 'finished_at', 'last_access'):
+            setattr(self, name, row[name])
+        for index, link in enumerate(links):
+            link['progress'] = {'phase': link['status']}
+            if index >= len(self.links):
+                self.links.append(link)
+                self._link_versions.append(0)
+                self._last_notify.append(0.0)
+            elif self.links[index] == link:
+                continue
+            else:
+                self.links[index] = link
+            self._bump(index)
+
+    def wait(self, timeout):
+        """Wait for a change - call with the lock held. Remote jobs are re-read from the store"""
+        if not self.remote:
+            self.changed.wait(timeout=timeout)
+            return
+        self.changed.wait(timeout=min(timeout, REMOTE_JOB_POLL_SECONDS))
+        record = JOB_STORE.load(self.id)
+        if record is not None:
+            self._apply(*record)
+        elif self.finished_at is None:
+            # Removed by the janitor - nothing more will happen
+            self.finished_at = time.time()
+
+    def update(self, **fields):
+        """Change job-level state (status, error, zip_path, timestamps) and wake readers"""
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.changed.notify_all()
+        if self.store is not None:
+            self.store.update_job(self.id, fields)
+
+    def touch(self):
+        """Note that a client looked at the job; retention counts from here"""
+        now = time.time()
+        self.last_access = now
+        if now - self._touched_at >= JOB_TOUCH_INTERVAL:
+            self._touched_at = now
+            JOB_STORE.touch(self.id)
+
+    def open_reader(self):
+        with self.lock:
+            self.readers += 1
+            self.last_access = time.time()
+
+    def close_reader(self):
+        with self.lock:
+            self.readers -= 1
+            self.last_access = time.time()
+
+    def link_dir(self, index):
+        """Each link downloads into its own subdirectory so its files are easy to attribute"""
+        return os.path.join(self.session_dir, str(index + 1))
+
+    def link_files(self, index):
+        """Files produced by a finished link, as reported by its download"""
+        files = self.links[index].get('files')
+        if files is not None:
+            return [f for f in files if os.path.isfile(f)]
+
+        # Old yt-dlp executables can't report the final path - fall back to the link's directory
+        link_dir = self.link_dir(index)
+        if not os.path.isdir(link_dir):
+            return []
+        return sorted(os.path.join(link_dir, f) for f in os.listdir(link_dir)
+                      if os.path.isfile(os.path.join(link_dir, f)))
+
+    def add_link(self, url, parent=None):
+        """Append a link (e.g. a playlist entry) and return its index"""
+        with self.changed:
+            self.links.append({'url': url, 'title': url, 'status': 'queued', 'error': None,
+                               'progress': {'phase': 'queued'}, 'parent': parent})
+            self._link_versions.append(0)
+            self._last_notify.append(0.0)
+            index = len(self.links) - 1
+            link = dict(self.links[index])
+            self._bump(index)
+            self.changed.notify_all()
+        if self.store is not None:
+            self.store.add_link(self.id, index, link)
+        return index
+
+    def _bump(self, index):
+        self.version += 1
+        self._link_versions[index] = self.version
+
+    def set_link(self, index, **fields):
+        with self.changed:
+            self.links[index].update(fields)
+            if 'status' in fields:
+                # A new status starts a new phase, until the yt-dlp hooks report finer ones
+                self.links[index]['progress'] = {'phase': fields['status']}
+            self._bump(index)
+            self.changed.notify_all()
+        if self.store is not None:
+            self.store.update_link(self.id, index, fields)
+
+    def report_progress(self, index, phase, **fields):
+        """Record a link's latest progress; called from yt-dlp hooks on worker threads.
+
+        Only the newest values are kept and readers are woken at most every
+        PROGRESS_NOTIFY_INTERVAL per link (phase changes always wake them),
+        so a slow SSE client never holds up a download.
+        """
+        with self.changed:
+            previous = self.links[index]['progress']
+            update = dict(previous) if previous.get('phase') == phase else {}
+            update.update(fields)
+            update['phase'] = phase
+            self.links[index]['progress'] = update
+            self._bump(index)
+            now = time.time()
+            if previous.get('phase') != phase or now - self._last_notify[index] >= PROGRESS_NOTIFY_INTERVAL:
+                self._last_notify[index] = now
+                self.changed.notify_all()
+
+    def changes_since(self, version):
+        """(current version, [(index, link)] changed after version) - call with the lock held"""
+        changed = [(i, dict(link)) for i, link in enumerate(self.links)
+                   if self._link_versions[i] > version]
+        return self.version, changed
+
+    def to_dict(self):
+        with self.lock:
+            links = [dict(link) for link in self.links]
+            for link in links:
+                # Don't expose server paths, only the names inside the zip
+                files = link.pop('files', None)
+                if files is not None:
+                    link['filenames'] = [os.path.basename(f) for f in files]
+            data = {
+                'job_id': self.id,
+                'session_id': self.id,
+                'status': self.status,
+                'error': self.error,
+                'links': links,
+                'has_file': self.zip_path is not None,
+                'archive_mode': self.archive_mode,
+                'stream_url': f'/download_stream/{self.id}',
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+        data['successful'] = [{'url': l['url'], 'title': l['title'],
+                               'conversion': l.get('conversion')}
+                              for l in links if l['status'] == 'done']
+        data['rejected'] = [{'url': l['url'], 'title': l['title'], 'reason': l['error']}
+                            for l in links if l['status'] == 'failed']
+        return data
+
+
+# Jobs by id (the id doubles as the session directory name)
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+
+
+def get_job(job_id):
+    """The job run by this process, or a read-only copy of one another worker runs"""
+    with JOBS_LOCK:
+        job = JOBS.get(job_id)
+    if job is None:
+        job = DownloadJob.from_store(JOB_STORE, job_id)
+    if job is not None:
+        job.touch()
+    return job
+
+
+def is_valid_job_id(job_id):
+    """Job ids are uuid4 hex strings - reject anything else before touching the filesystem"""
+    return len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+
+def run_download_job(job):
+    """Download every link of a job, then package the results into a zip"""
+    session_dir = job.session_dir
+    job.update(status='running', started_at=job.started_at or time.time())
+
+    # A resumed job skips links that already finished
+    with job.lock:
+        links = [(i, link['url'], link['status'], link.get('parent'))
+                 for i, link in enumerate(job.links)]
+    try:
+        # Download all links in parallel
+        errors = []
 
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] Starting parallel downloads: {len(links)} links, {MAX_PARALLEL_DOWNLOADS} at a time")
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] [{job.id[:8]}] Starting parallel downloads: {len(links)} links, {MAX_PARALLEL_DOWNLOADS} workers shared across requests")
 
-        def download_with_error_handling(url):
+        def download_with_error_handling(index, url):
             """Download a single URL and return (url, success, error)"""
+            job.set_link(index, status='downloading')
             try:
                 print(
                     f"[{datetime.now().strftime('%H:%M:%S')}] [PARALLEL] Downloading: {url}")
-                success, error = download_audio(url, session_dir)
+                link_dir = job.link_dir(index)
+                os.makedirs(link_dir, exist_ok=True)
+                success, error, media = download_audio(
+                    url, link_dir,
+                    progress=lambda phase, **fields: job.report_progress(index, phase, **fields))
                 if not success:
                     print(
                         f"[{datetime.now().strftime('%H:%M:%S')}] [PARALLEL] Download failed for {url}: {error}")
                     # Truncate long error messages for user display
                     error_msg = str(error)[:200] if len(
                         str(error)) > 200 else str(error)
+                    job.set_link(index, status='failed', error=error_msg)
+                    METRICS.inc('linkdl_links_total', result='failed')
                     return (url, False, error_msg)
                 else:
                     print(
                         f"[{datetime.now().strftime('%H:%M:%S')}] [PARALLEL] Successfully downloaded: {url}")
+                    fields = {'status': 'done'}
+                    if media and media.get('filepath'):
+                        fields['files'] = [media['filepath']]
+                    if media and media.get('title'):
+                        fields['title'] = media['title']
+                    if media and media.get('conversion'):
+                        fields['conversion'] = media['conversion']
+                        METRICS.inc('linkdl_conversions_total',
+                                    path=media['conversion'])
+                    job.set_link(index, **fields)
+                    METRICS.inc('linkdl_links_total', result='done')
                     return (url, True, None)
             except Exception as e:
                 # Catch individual download errors so one doesn't stop the others
                 error_msg = f"Unexpected error: {str(e)[:200]}"
                 print(
                     f"[{datetime.now().strftime('%H:%M:%S')}] [PARALLEL] Exception downloading {url}: {error_msg}")
+                job.set_link(index, status='failed', error=error_msg)
+                METRICS.inc('linkdl_links_total', result='failed')
                 return (url, False, error_msg)
 
-        # Execute downloads in parallel
+        # Hand links to the shared scheduler, at most MAX_LINKS_IN_FLIGHT_PER_JOB at a time
         start_time = time.time()
-        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS) as executor:
-            # Submit all download tasks
-            future_to_url = {executor.submit(
-                download_with_error_handling, url): url for url in links}
-
-            # Collect results as they complete
-            completed_count = 0
-            for future in as_completed(future_to_url):
-                url, success, error = future.result()
-                completed_count += 1
-                if not success:
-                    errors.append(f"{url}: {error}")
-                print(
-                    f"[{datetime.now().strftime('%H:%M:%S')}] Progress: {completed_count}/{len(links)} downloads completed")
+        future_to_url = {}
+        in_flight = threading.BoundedSemaphore(MAX_LINKS_IN_FLIGHT_PER_JOB)
 
-        elapsed_time = time.time() - start_time
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] All downloads completed in {elapsed_time:.1f} seconds ({len(links)} links, {MAX_PARALLEL_DOWNLOADS} parallel)")
+        def schedule(index, url):
+            in_flight.acquire()
+            try:
+                future = DOWNLOAD_SCHEDULER.submit(
+                    download_with_error_handling, index, url, host=host_key(url), block=True)
+            except BaseException:
+                in_flight.release()
+                raise
+            future.add_done_callback(lambda _: in_flight.release())
+            future_to_url[future] = url
+
+        for i, url, status, parent in links:
+            if status in TERMINAL_LINK_STATUSES:
+                continue
+            if status == 'expanding' or (parent is None and looks_like_playlist(url)):
+                expand_playlist(job, i, url, schedule)
+                if job.links[i]['status'] == 'failed':
+                    errors.append(f"{url}: {job.links[i]['error']}")
+            else:
+                schedule(i, url)
+
+        # Collect results as they complete
+        completed_count = 0
+        for future in as_completed(future_to_url):
+            url, success, error = future.result()
+            completed_count += 1
+            if not success:
+                errors.append(f"{url}: {error}")
+            print(
+                f"[{datetime.now().strftime('%H:%M:%S')}] Progress: {completed_count}/{len(future_to_url)} downloads completed")
 
-        # Wait a moment for all downloads to fully complete and files to be written
-        time.sleep(2)
+        elapsed_time = time.time() - start_time
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] All downloads completed in {elapsed_time:.1f} seconds ({len(future_to_url)} links)")
 
-        # Get all downloaded files (files that weren't there before)
-        files_after = set(os.listdir(session_dir))
-        new_files = files_after - files_before
-        all_files = [os.path.join(session_dir, f) for f in new_files if os.path.isfile(
-            os.path.join(session_dir, f))]
+        # Get all downloaded files
+        all_files = []
+        for i, link in enumerate(job.links):
+            if link['status'] == 'done':
+                all_files += job.link_files(i)
 
         if not all_files:
             error_msg = 'No files were downloaded.'
@@ -453,23 +3099,558 @@ def download():
                     '; '.join(errors[:5])  # Show max 5 errors
                 if len(errors) > 5:
                     error_msg += f' (and {len(errors) - 5} more errors)'
-            return jsonify({'error': error_msg}), 500
+            job.update(status='failed', error=error_msg)
+            return
+
+        # Streamed jobs are packaged on the fly by /download_stream
+        if job.archive_mode == 'stream':
+            job.update(status='finished')
+            return
 
         # Create a zip file
+        zip_started = time.time()
         zip_path = os.path.join(session_dir, 'downloads.zip')
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        arcnames = ArchiveNames()
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
             for file_path in all_files:
-                if os.path.exists(file_path) and file_path != zip_path:
-                    zipf.write(file_path, os.path.basename(file_path))
-
-        # Send the zip file
-        return send_file(
-            zip_path,
-            as_attachment=True,
-            download_name='link-downloader-files.zip',
-            mimetype='application/zip'
-        )
+                if os.path.exists(file_path):
+                    zipf.write(file_path, arcnames.add(file_path),
+                               compress_type=zip_compression_for(file_path))
+        METRICS.observe('linkdl_stage_seconds',
+                        time.time() - zip_started, stage='zip')
+
+        job.update(zip_path=zip_path, status='finished')
+
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        # Log full error to server logs
+        print(f"Error in download job {job.id}: {error_trace}")
+        job.update(status='failed', error=f'Server error: {str(e)[:200]}')
+
+    finally:
+        job.update(finished_at=time.time())
+        METRICS.observe('linkdl_stage_seconds',
+                        job.finished_at - job.created_at, stage='job')
+        JANITOR.poke()
+
+
+# Audio/video is already compressed - deflating it burns CPU for ~0% gain
+MEDIA_EXTENSIONS = {'.m4a', '.mp3', '.aac', '.opus', '.ogg', '.oga', '.webm', '.mka',
+                    '.flac', '.wav', '.mp4', '.mkv', '.mov'}
+
+# Bytes read from disk per write into a streamed zip
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def zip_compression_for(file_path):
+    """ZIP_STORED for media files, ZIP_DEFLATED for anything else"""
+    if os.path.splitext(file_path)[1].lower() in MEDIA_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class ArchiveNames:
+    """Hands out unique names inside a zip when two links produce the same filename"""
+
+    def __init__(self):
+        self._used = set()
+
+    def add(self, file_path):
+        name = os.path.basename(file_path)
+        stem, ext = os.path.splitext(name)
+        counter = 2
+        while name in self._used:
+            name = f"{stem} ({counter}){ext}"
+            counter += 1
+        self._used.add(name)
+        return name
+
+
+class _StreamBuffer:
+    """Write-only file object that collects zipfile output until the generator yields it"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        # zipfile needs tell() to record offsets; without seek() it writes data descriptors
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_job_archive(job):
+    """Yield a zip of the job's files, adding each link's files as soon as it finishes"""
+    buffer = _StreamBuffer()
+    arcnames = ArchiveNames()
+    sent = set()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        while True:
+            with job.changed:
+                ready = [i for i, link in enumerate(job.links)
+                         if link['status'] in TERMINAL_LINK_STATUSES and i not in sent]
+                if not ready:
+                    if job.finished_at is not None:
+                        # Links a failed job left unfinished never will be, so stop here
+                        break
+                    job.wait(timeout=30)
+                    continue
+                statuses = {i: job.links[i]['status'] for i in ready}
+
+            for i in ready:
+                sent.add(i)
+                if statuses[i] != 'done':
+                    continue
+                for file_path in job.link_files(i):
+                    zinfo = zipfile.ZipInfo.from_file(
+                        file_path, arcnames.add(file_path))
+                    zinfo.compress_type = zip_compression_for(file_path)
+                    with open(file_path, 'rb') as src, \
+                            zipf.open(zinfo, 'w', force_zip64=zinfo.file_size > 0x7fffffff) as dest:
+                        while True:
+                            chunk = src.read(STREAM_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            yield buffer.drain()
+                    yield buffer.drain()
+    # Central directory, written when the ZipFile closes
+    yield buffer.drain()
+
+
+def expand_playlist(job, index, url, schedule):
+    """Turn a playlist link into one link per entry, scheduling each as it's discovered"""
+    job.set_link(index, status='expanding')
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] [{job.id[:8]}] Expanding playlist: {url}")
+    # Entries added before a restart are already links of the (resumed) job, and
+    # entries also submitted on their own (or listed twice) are only downloaded once
+    with job.lock:
+        known = {link_key(link['url']) for link in job.links}
+    count = 0
+    try:
+        for entry_url in iter_playlist_entries(url, check_cookies_file()):
+            entry_url = canonical_url(entry_url)
+            key = link_key(entry_url)
+            if key in known:
+                count += 1
+                continue
+            known.add(key)
+            if len(job.links) >= MAX_LINKS_PER_JOB:
+                print(
+                    f"[{job.id[:8]}] Playlist truncated at {MAX_LINKS_PER_JOB} links: {url}")
+                break
+            schedule(job.add_link(entry_url, parent=index), entry_url)
+            count += 1
+    except Exception as e:
+        if count == 0:
+            job.set_link(index, status='failed',
+                         error=f"Could not read playlist: {str(e)[:200]}")
+            return
+        print(f"[{job.id[:8]}] Playlist listing stopped early for {url}: {e}")
+
+    if count == 0:
+        job.set_link(index, status='failed', error='Playlist has no entries')
+    else:
+        job.set_link(index, status='expanded', entries=count)
+
+
+def resume_job(job_id):
+    """Restart a job whose worker went away, re-running the links that hadn't finished"""
+    job = DownloadJob.from_store(JOB_STORE, job_id, remote=False)
+    if job is None:
+        return
+    for i, link in enumerate(job.links):
+        if link['status'] not in TERMINAL_LINK_STATUSES + ('queued', 'expanding'):
+            job.set_link(i, status='queued')
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] [{job_id[:8]}] Resuming job ({len(job.links)} links)")
+    with JOBS_LOCK:
+        JOBS[job_id] = job
+    threading.Thread(target=run_download_job,
+                     args=(job,), daemon=True).start()
+
+
+def owned_job_ids():
+    """Unfinished jobs this process is running"""
+    with JOBS_LOCK:
+        return [job.id for job in JOBS.values() if job.finished_at is None]
+
+
+def directory_size(path):
+    """Total bytes of the regular files under path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Janitor:
+    """One background thread that keeps DOWNLOAD_DIR within its TTL and byte quota.
+
+    Finished jobs are removed RESULT_RETENTION_SECONDS after they were last
+    fetched or polled, or earlier (least recently used first) when the
+    directory grows past DOWNLOAD_QUOTA_BYTES. Jobs still running or with a
+    client mid-download are never touched. Session directories without a job
+    in JOB_STORE are removed too.
+    """
+
+    def __init__(self, root, retention, quota_bytes, interval):
+        self.root = root
+        self.retention = retention
+        self.quota_bytes = quota_bytes
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._last_sweep = None
+        self._bytes = 0
+        self._removed = {'expired': 0, 'quota': 0, 'orphaned': 0}
+
+    def start(self):
+        """Sweep leftovers from a previous run, then keep sweeping in the background"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+        self.sweep()
+        self._thread.start()
+
+    def poke(self):
+        """Sweep soon, e.g. after a big job finished"""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=self.interval)
+            self._wake.clear()
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] Janitor sweep failed: {e}")
+
+    def _remove(self, path, reason, job_id=None):
+        shutil.rmtree(path, ignore_errors=True)
+        if job_id is not None:
+            with JOBS_LOCK:
+                JOBS.pop(job_id, None)
+            JOB_STORE.delete(job_id)
+        with self._lock:
+            self._removed[reason] += 1
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Janitor removed {os.path.basename(path)} ({reason})")
+
+    def sweep(self):
+        """Remove orphaned and expired sessions, then evict until under quota.
+
+        Files and directories without a job only go once they're older than the
+        retention window, at startup too: a sibling worker process may be writing
+        them (an info JSON, a session directory whose job isn't recorded yet).
+        """
+        now = time.time()
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+
+        with JOBS_LOCK:
+            jobs = dict(JOBS)
+        # Jobs of every worker process, so one worker never sweeps another's files
+        records = JOB_STORE.records()
+
+        total = 0
+        evictable = []  # (last_access, size, path, job)
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                mtime = os.lstat(path).st_mtime
+            except OSError:
+                continue
+
+            if not os.path.isdir(path):
+                # Stray temp files (e.g. info JSON) are never needed past the retention window
+                if now - mtime > self.retention:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                else:
+                    total += os.path.getsize(path)
+                continue
+
+            record = records.get(name)
+            if record is None:
+                # Grace period for a directory whose job is being registered right now
+                if now - mtime > self.retention:
+                    self._remove(path, 'orphaned')
+                else:
+                    total += directory_size(path)
+                continue
+
+            size = directory_size(path)
+            finished = record['finished_at'] is not None
+            last_access = max(record['last_access'], record['finished_at'] or 0)
+            in_use = False
+            job = jobs.get(name)
+            if job is not None:
+                with job.lock:
+                    in_use = job.readers > 0
+                    last_access = max(last_access, job.last_access)
+            if finished and not in_use:
+                if now - last_access > self.retention:
+                    self._remove(path, 'expired', name)
+                    continue
+                evictable.append((last_access, size, path, name))
+            total += size
+
+        # Over quota: drop the least recently used finished jobs first
+        evictable.sort(key=lambda item: item[0])
+        for _, size, path, job_id in evictable:
+            if total <= self.quota_bytes:
+                break
+            self._remove(path, 'quota', job_id)
+            total -= size
+
+        with self._lock:
+            self._bytes = total
+            self._last_sweep = now
+
+        PARTIAL_DOWNLOADS.sweep()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'bytes': self._bytes,
+                'quota_bytes': self.quota_bytes,
+                'retention_seconds': self.retention,
+                'removed': dict(self._removed),
+                'last_sweep': self._last_sweep,
+            }
+
+
+JANITOR = Janitor(DOWNLOAD_DIR, RESULT_RETENTION_SECONDS,
+                  DOWNLOAD_QUOTA_BYTES, JANITOR_INTERVAL_SECONDS)
+
+
+# A drain only applies to processes started before it was requested, so the
+# restarted server comes up accepting jobs
+PROCESS_STARTED_AT = time.time()
+DRAIN_MODES = ('wait', 'checkpoint')
+# If set, /drain requires this value in an X-Drain-Token header; otherwise only local, unproxied calls
+DRAIN_TOKEN = os.getenv('DRAIN_TOKEN', '')
+
+
+class DrainController:
+    """Graceful drain before a restart, shared by all worker processes through JOB_STORE.
+
+    While draining, /download refuses new jobs. In 'wait' mode every job
+    runs to completion. In 'checkpoint' mode workers also stop starting
+    queued links - they stay queued in the store and the next process
+    resumes them - so only downloads already running have to finish.
+    """
+
+    REFRESH_SECONDS = 1.0
+
+    def __init__(self, store, scheduler):
+        self.store = store
+        self.scheduler = scheduler
+        self._lock = threading.Lock()
+        self._state = None
+        self._checked_at = 0.0
+
+    def _load(self):
+        state = self.store.get_state('drain')
+        if state and state.get('requested_at', 0) < PROCESS_STARTED_AT:
+            state = None  # Left over from before this process started
+        self._state = state
+        self._checked_at = time.time()
+        if state and state['mode'] == 'checkpoint':
+            self.scheduler.pause()
+        else:
+            self.scheduler.resume()
+
+    def current(self):
+        """The active drain ({'mode', 'requested_at'}) or None, re-read at most every REFRESH_SECONDS"""
+        with self._lock:
+            if time.time() - self._checked_at >= self.REFRESH_SECONDS:
+                self._load()
+            return self._state
+
+    def begin(self, mode):
+        with self._lock:
+            self.store.set_state(
+                'drain', {'mode': mode, 'requested_at': time.time()})
+            self._load()
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Draining ({mode}): no new jobs accepted")
+
+    def cancel(self):
+        with self._lock:
+            self.store.set_state('drain', None)
+            self._load()
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Drain cancelled, accepting jobs again")
+
+    def stats(self):
+        state = self.current()
+        remaining = self.store.remaining_work()
+        if remaining['jobs'] == 0:
+            safe = True
+        elif state and state['mode'] == 'checkpoint':
+            # Queued and half-expanded links are picked up again from the store
+            safe = remaining['downloading'] == 0
+        else:
+            safe = False
+        return {
+            'draining': state is not None,
+            'mode': state['mode'] if state else None,
+            'requested_at': state['requested_at'] if state else None,
+            'remaining': remaining,
+            'safe_to_restart': safe,
+        }
+
+
+DRAIN = DrainController(JOB_STORE, DOWNLOAD_SCHEDULER)
+
+
+def drain_allowed():
+    """Drain control is for deploy scripts on the machine itself, or callers holding DRAIN_TOKEN"""
+    if DRAIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Drain-Token', ''), DRAIN_TOKEN)
+    # Requests through nginx also come from 127.0.0.1, but carry X-Forwarded-For
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
 
+@app.route('/drain', methods=['GET', 'POST', 'DELETE'])
+def drain():
+    """Start (POST), check (GET) or cancel (DELETE) a graceful drain before a restart.
+
+    Answers 200 once it's safe to restart, 202 while work remains.
+    """
+    if not drain_allowed():
+        return jsonify({'error': 'Not found'}), 404
+
+    if request.method == 'POST':
+        mode = get_request_option('mode') or 'checkpoint'
+        if mode not in DRAIN_MODES:
+            return jsonify({'error': f"mode must be one of: {', '.join(DRAIN_MODES)}"}), 400
+        DRAIN.begin(mode)
+    elif request.method == 'DELETE':
+        DRAIN.cancel()
+
+    stats = DRAIN.stats()
+    return jsonify(stats), 200 if stats['safe_to_restart'] else 202
+
+
+@app.route('/validate', methods=['POST'])
+def validate():
+    """Check every link's metadata in parallel without downloading anything"""
+    try:
+        links = get_request_links()
+        if not links:
+            return jsonify({'error': 'No links provided'}), 400
+
+        use_cookies = check_cookies_file()
+
+        def check_link(submitted_url, url):
+            info = INFO_CACHE.get(url)
+            error_msg = None
+            if info is None:
+                started = time.time()
+                info, error_msg = extract_metadata(url, use_cookies)
+                METRICS.observe('linkdl_stage_seconds',
+                                time.time() - started, stage='metadata')
+            reason = rejection_reason(info, error_msg)
+            title = (info or {}).get('title') or submitted_url
+            if (info or {}).get('_type') == 'playlist':
+                title = f'Playlist: {title}'
+            if reason is None:
+                INFO_CACHE.set(url, info)
+            return {'url': submitted_url, 'title': title, 'reason': reason}
+
+        futures = [(submitted_url, VALIDATION_EXECUTOR.submit(check_link, submitted_url, url))
+                   for submitted_url, url in links]
+        results = []
+        for submitted_url, future in futures:
+            # Each check is bounded by METADATA_TIMEOUT and the ones before it are done,
+            # so it waits at most for a check already running ahead of it plus its own
+            try:
+                results.append(future.result(timeout=2 * METADATA_TIMEOUT))
+            except FutureTimeoutError:
+                future.cancel()
+                results.append({'url': submitted_url, 'title': submitted_url,
+                                'reason': 'Timed out while checking the link'})
+
+        return jsonify({
+            'valid': [{'url': r['url'], 'title': r['title']} for r in results if r['reason'] is None],
+            'invalid': [r for r in results if r['reason'] is not None],
+        })
+    except InvalidLinksError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        import traceback
+        print(f"Error in validate route: {traceback.format_exc()}")
+        return jsonify({'error': f'Server error: {str(e)[:200]}'}), 500
+
+
+@app.route('/download', methods=['POST'])
+# @limiter.limit("5 per minute")  # Uncomment to enable rate limiting
+def download():
+    """Queue a download job and return its id immediately"""
+    try:
+        # Get all links from the form
+        links = [url for _, url in get_request_links()]
+
+        print(f"Received {len(links)} links to download")
+
+        if not links:
+            return jsonify({'error': 'No links provided'}), 400
+
+        if DRAIN.current() is not None:
+            response = jsonify(
+                {'error': 'Server is restarting, please try again in a moment'})
+            response.headers['Retry-After'] = '30'
+            return response, 503
+
+        # Refuse up front while the queue is full. Each job only feeds in its share of
+        # links at a time, so this means several jobs are waiting, not one big one
+        if DOWNLOAD_SCHEDULER.free_slots() <= 0:
+            response = jsonify(
+                {'error': 'Server is busy, please try again in a minute'})
+            response.headers['Retry-After'] = '60'
+            return response, 503
+
+        # Record the job first so no worker's janitor takes its directory for an orphan
+        job_id = uuid.uuid4().hex
+        session_dir = os.path.join(DOWNLOAD_DIR, job_id)
+        archive_mode = 'stream' if get_request_option(
+            'archive') == 'stream' else 'file'
+        job = DownloadJob(job_id, session_dir, links,
+                          archive_mode, store=JOB_STORE)
+        with JOBS_LOCK:
+            JOBS[job_id] = job
+        # Directory for this download session, named after the job
+        os.makedirs(session_dir)
+
+        threading.Thread(target=run_download_job,
+                         args=(job,), daemon=True).start()
+
+        return jsonify(job.to_dict()), 202
+
+    except InvalidLinksError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
@@ -478,32 +3659,122 @@ def download():
         # Return user-friendly error (don't expose full traceback)
         return jsonify({'error': f'Server error: {str(e)[:200]}'}), 500
 
-    finally:
-        # Clean up after a delay (give time for file to be sent)
-        if session_dir:
-            def cleanup():
-                time.sleep(10)  # Wait 10 seconds before cleanup
-                if os.path.exists(session_dir):
-                    shutil.rmtree(session_dir, ignore_errors=True)
-
-                # Remove from active downloads
-                ACTIVE_DOWNLOADS.discard(session_dir)
-
-                # Remove lock file if no more active downloads
-                if len(ACTIVE_DOWNLOADS) == 0:
-                    try:
-                        if os.path.exists(DOWNLOAD_LOCK_FILE):
-                            os.remove(DOWNLOAD_LOCK_FILE)
-                    except Exception:
-                        pass  # Non-critical
 
-            threading.Thread(target=cleanup, daemon=True).start()
+@app.route('/download_stream/<job_id>', methods=['GET'])
+def download_stream(job_id):
+    """Stream a job's zip, writing each file into the response as its download completes"""
+    job = get_job(job_id) if is_valid_job_id(job_id) else None
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    job.open_reader()
+    response = Response(
+        stream_with_context(stream_job_archive(job)),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': 'attachment; filename=link-downloader-files.zip',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+    response.call_on_close(job.close_reader)
+    return response
+
+
+def job_events(job):
+    """Yield Server-Sent Events with per-link progress until the job is over"""
+    version = -1
+    last_sent = time.time()
+    while True:
+        with job.changed:
+            if job.version == version and job.finished_at is None:
+                job.wait(timeout=PROGRESS_NOTIFY_INTERVAL * 2)
+            version, changed = job.changes_since(version)
+            job_over = job.finished_at is not None
+
+        for index, link in changed:
+            payload = dict(link['progress'], index=index,
+                           url=link['url'], title=link['title'])
+            if link['error']:
+                payload['error'] = link['error']
+            if link.get('parent') is not None:
+                payload['parent'] = link['parent']
+            if link.get('conversion'):
+                payload['conversion'] = link['conversion']
+            yield f"event: link\ndata: {json.dumps(payload)}\n\n"
+            last_sent = time.time()
+        if time.time() - last_sent >= 15:
+            # Keeps proxies from closing an idle connection
+            yield ": keep-alive\n\n"
+            last_sent = time.time()
+
+        if job_over:
+            yield f"event: job\ndata: {json.dumps(job.to_dict())}\n\n"
+            return
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events_stream(job_id):
+    """Live per-link progress for a job as Server-Sent Events"""
+    job = get_job(job_id) if is_valid_job_id(job_id) else None
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return Response(
+        stream_with_context(job_events(job)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the state of a download job and each of its links"""
+    job = get_job(job_id) if is_valid_job_id(job_id) else None
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/download_file/<session_id>', methods=['GET'])
+def download_file(session_id):
+    """Serve the finished zip for a job"""
+    job = get_job(session_id) if is_valid_job_id(session_id) else None
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.zip_path is None or not os.path.exists(job.zip_path):
+        return jsonify({'error': 'File not ready', 'status': job.status}), 409
+
+    # send_file opens the zip right away, so a later janitor sweep can't cut this download short
+    return send_file(
+        job.zip_path,
+        as_attachment=True,
+        download_name='link-downloader-files.zip',
+        mimetype='application/zip'
+    )
+
+
+# Resolve yt-dlp once at startup so no request pays for the lookup and version probe
+TOOLS.yt_dlp_path()
+
+# `python app.py` in debug mode runs a Werkzeug reloader parent that only watches files
+# and re-runs this module in a child; background work belongs to the child alone
+DEBUG_MODE = os.getenv('FLASK_ENV') != 'production'
+RELOADER_PARENT = (__name__ == '__main__' and DEBUG_MODE
+                   and os.environ.get('WERKZEUG_RUN_MAIN') != 'true')
+
+if not RELOADER_PARENT:
+    # Pick up jobs a previous run (or a dead worker) left unfinished
+    JOB_STORE.start(owned_job_ids, resume_job,
+                    accepting=lambda: DRAIN.current() is None)
+
+    # Clear sessions left behind by a previous run and start enforcing retention
+    JANITOR.start()
 
 
 if __name__ == '__main__':
     # Development mode
     environment = os.getenv('ENVIRONMENT', 'production')
-    debug_mode = os.getenv('FLASK_ENV') != 'production'
+    debug_mode = DEBUG_MODE
 
     print(f"Starting Link Downloader server...")
     print(f"Environment: {environment}")
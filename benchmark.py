@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the download pipeline
+
+Drives /download -> /jobs -> /download_file through Flask's test client
+without touching YouTube. Two modes:
+
+    stub     - a fake yt-dlp executable with configurable latency, failure
+               rate and output size (subprocess engine, YouTube-style URLs so
+               the strategy fallback chain is exercised)
+    generic  - a local HTTP server serving synthetic WAV files, downloaded by
+               the real yt-dlp through its generic extractor (needs ffmpeg)
+
+Every (batch size, concurrency) combination runs in a fresh process so peak
+RSS is measured per combination. Reports jobs/sec, links/sec, p50/p95 job
+latency, the server's peak RSS and the peak of the server plus its yt-dlp and
+ffmpeg processes.
+
+Usage:
+    python3 benchmark.py
+    python3 benchmark.py --batches 1,4,10 --concurrency 1,4,8 --jobs 20
+    python3 benchmark.py --mode stub --latency 1.0 --failure-rate 0.2
+    python3 benchmark.py --mode generic --engine subprocess --json results.json
+
+Downloads, the audio cache and the job store go to a temporary directory; run it on a
+development machine, not next to a live server.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Fake yt-dlp. Speaks the parts of the CLI app.py relies on: --version,
+# --dump-single-json, -P/-o, --load-info-json, the progress templates and the
+# after_move --print line (prefixes must match CLI_*_PROGRESS_PREFIX in app.py)
+STUB_YT_DLP = r'''#!/usr/bin/env python3
+import json, os, random, sys, time
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('2099.01.01')
+    sys.exit(0)
+
+latency = float(os.environ.get('BENCH_STUB_LATENCY', '0.5'))
+failure_rate = float(os.environ.get('BENCH_STUB_FAILURE_RATE', '0'))
+size = int(float(os.environ.get('BENCH_STUB_SIZE_KB', '4096')) * 1024)
+
+
+def option(flag):
+    return args[args.index(flag) + 1] if flag in args else None
+
+
+info_file = option('--load-info-json')
+if info_file:
+    with open(info_file) as f:
+        video_id = json.load(f).get('id', 'unknown')
+else:
+    video_id = args[-1].rsplit('=', 1)[-1].rsplit('/', 1)[-1]
+info = {'_type': 'video', 'id': video_id, 'title': f'Benchmark {video_id}',
+        'duration': 240, 'extractor_key': 'Youtube', 'webpage_url': args[-1]}
+
+if '--dump-single-json' in args:
+    time.sleep(latency * 0.2)
+    print(json.dumps(info))
+    sys.exit(0)
+
+# Extraction
+time.sleep(latency * 0.2)
+if random.random() < failure_rate:
+    print(f"ERROR: [youtube] {video_id}: Sign in to confirm you're not a bot", file=sys.stderr)
+    sys.exit(1)
+
+# Transfer, with progress lines like --progress-template produces
+steps = 5
+for step in range(1, steps + 1):
+    time.sleep(latency * 0.6 / steps)
+    print(f'[ld-progress] {size * step // steps} {size} NA {size / latency:.0f} 0', flush=True)
+
+# Post-processing
+print('[ld-postprocess] started FFmpegExtractAudio', file=sys.stderr, flush=True)
+time.sleep(latency * 0.2)
+# -P DIR is the output directory; -P temp:DIR only holds partial files
+home = next((args[i + 1] for i, arg in enumerate(args[:-1])
+             if arg == '-P' and not args[i + 1].startswith('temp:')), '')
+path = os.path.join(home, option('-o').replace('%(title)s', info['title']).replace('%(ext)s', 'm4a'))
+with open(path, 'wb') as f:
+    f.write(os.urandom(min(size, 65536)) * (size // 65536 + 1))
+    f.truncate(size)
+print(json.dumps({'extractor_key': 'Youtube', 'id': video_id, 'title': info['title'],
+                  'filepath': path, 'acodec': 'mp4a.40.2'}))
+'''
+
+
+def write_stub(bin_dir):
+    """Install the fake yt-dlp into bin_dir"""
+    path = os.path.join(bin_dir, 'yt-dlp')
+    with open(path, 'w') as f:
+        f.write(STUB_YT_DLP.replace('/usr/bin/env python3', sys.executable, 1))
+    os.chmod(path, 0o755)
+    return path
+
+
+def write_wav(path, size):
+    """Write a silent 16-bit mono WAV of roughly size bytes"""
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(22050)
+        w.writeframes(b'\x00\x00' * max(size // 2, 22050))
+
+
+def start_media_server(media_dir):
+    """Serve media_dir on a free localhost port, returning the base URL"""
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=media_dir, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_combination(options):
+    """Child process: import the app and push options.jobs batches through it"""
+    base_url = None
+    if options.mode == 'generic':
+        media_dir = os.path.join(options.work_dir, 'media')
+        os.makedirs(media_dir)
+        size = int(options.size_kb * 1024)
+        # One file per link so neither cache short-circuits the download
+        for n in range(options.jobs * options.batch):
+            write_wav(os.path.join(media_dir, f'{n}.wav'), size)
+        base_url = start_media_server(media_dir)
+
+    # Keep the app's own logging out of the report
+    log = sys.stdout
+    if not options.verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    import app
+
+    counter = iter(range(options.jobs * options.batch))
+    counter_lock = threading.Lock()
+
+    def next_urls():
+        with counter_lock:
+            numbers = [next(counter) for _ in range(options.batch)]
+        if base_url:
+            return [f'{base_url}/{n}.wav' for n in numbers]
+        # 11-character ids so they parse like real YouTube links
+        return [f'https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}' for _ in numbers]
+
+    latencies = []
+    results = {'finished': 0, 'failed': 0, 'rejected': 0, 'links_done': 0}
+    results_lock = threading.Lock()
+    jobs_left = [options.jobs]
+
+    def client():
+        http = app.app.test_client()
+        while True:
+            with results_lock:
+                if jobs_left[0] <= 0:
+                    return
+                jobs_left[0] -= 1
+            started = time.time()
+            urls = next_urls()
+            response = http.post('/download', json={'urls': urls})
+            while response.status_code == 503:
+                with results_lock:
+                    results['rejected'] += 1
+                time.sleep(0.2)
+                response = http.post('/download', json={'urls': urls})
+            job_id = response.get_json()['job_id']
+
+            while True:
+                job = http.get(f'/jobs/{job_id}').get_json()
+                if job['status'] in ('finished', 'failed'):
+                    break
+                time.sleep(0.02)
+            if job['has_file']:
+                http.get(f'/download_file/{job_id}').get_data()
+
+            with results_lock:
+                latencies.append(time.time() - started)
+                results['finished' if job['status'] == 'finished' else 'failed'] += 1
+                results['links_done'] += len(job['successful'])
+
+    # ru_maxrss of children is misleading (a fork counts the parent's pages),
+    # so the server plus its yt-dlp/ffmpeg processes are sampled instead
+    peak_tree = [0]
+    running = threading.Event()
+    running.set()
+
+    def sample_rss():
+        while running.is_set():
+            tree = app.descendant_rss(os.getpid())
+            try:
+                with open('/proc/self/statm') as f:
+                    tree += int(f.read().split()[1]) * app.PAGE_SIZE
+            except OSError:
+                pass
+            peak_tree[0] = max(peak_tree[0], tree)
+            time.sleep(0.1)
+
+    threading.Thread(target=sample_rss, daemon=True).start()
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for _ in range(options.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    running.clear()
+
+    sys.stdout = log
+    # ru_maxrss is in KB on Linux
+    server_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({
+        'mode': options.mode,
+        'engine': app.DOWNLOAD_ENGINE,
+        'batch': options.batch,
+        'clients': options.clients,
+        'jobs': options.jobs,
+        'elapsed_seconds': round(elapsed, 3),
+        'jobs_per_second': round(options.jobs / elapsed, 3),
+        'links_per_second': round(results['links_done'] / elapsed, 3),
+        'p50_seconds': round(percentile(latencies, 0.5), 3),
+        'p95_seconds': round(percentile(latencies, 0.95), 3),
+        'peak_rss_mb': round(server_rss, 1),
+        'peak_tree_rss_mb': round(peak_tree[0] / 1048576, 1),
+        **results,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline benchmark for the download pipeline')
+    parser.add_argument('--mode', choices=('stub', 'generic'), default='stub')
+    parser.add_argument('--engine', choices=('inprocess', 'subprocess'),
+                        help='Download engine (stub mode always uses subprocess)')
+    parser.add_argument('--batches', default='1,4,10',
+                        help='Comma-separated links per job')
+    parser.add_argument('--concurrency', default='1,4,8',
+                        help='Comma-separated numbers of concurrent clients')
+    parser.add_argument('--jobs', type=int, default=12,
+                        help='Jobs submitted per combination')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='MAX_PARALLEL_DOWNLOADS for the app')
+    parser.add_argument('--latency', type=float, default=0.5,
+                        help='Stub: seconds per download attempt')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Stub: probability that an attempt fails')
+    parser.add_argument('--size-kb', type=float, default=4096,
+                        help='Size of each produced/served file')
+    parser.add_argument('--host-limits', action='store_true',
+                        help="Keep the app's per-host limits (off by default so they don't dominate)")
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the app's log output")
+    # Internal: run one combination in this process
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--batch', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--clients', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        run_combination(options)
+        return
+
+    if options.mode == 'generic' and not shutil.which('ffmpeg'):
+        parser.error('generic mode needs ffmpeg on PATH')
+
+    engine = 'subprocess' if options.mode == 'stub' else (options.engine or 'inprocess')
+    results = []
+    print(f"{'batch':>5} {'clients':>7} {'jobs/s':>7} {'links/s':>8} {'p50 s':>7} {'p95 s':>7} "
+          f"{'RSS MB':>7} {'tree MB':>8} {'ok':>4} {'fail':>4} {'503s':>5}")
+    for batch in [int(b) for b in options.batches.split(',')]:
+        for clients in [int(c) for c in options.concurrency.split(',')]:
+            work_dir = tempfile.mkdtemp(prefix='linkdl-bench-')
+            try:
+                bin_dir = os.path.join(work_dir, 'bin')
+                os.makedirs(bin_dir)
+                env = dict(os.environ,
+                           DOWNLOAD_ENGINE=engine,
+                           DOWNLOAD_DIR=os.path.join(work_dir, 'downloads'),
+                           # Job store, audio cache and partial downloads
+                           DATA_DIR=work_dir,
+                           MAX_PARALLEL_DOWNLOADS=str(options.workers),
+                           MAX_QUEUED_DOWNLOADS='1000',
+                           BENCH_STUB_LATENCY=str(options.latency),
+                           BENCH_STUB_FAILURE_RATE=str(options.failure_rate),
+                           BENCH_STUB_SIZE_KB=str(options.size_kb))
+                if options.mode == 'stub':
+                    write_stub(bin_dir)
+                    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+                if not options.host_limits:
+                    unlimited = {'concurrency': 1000, 'rate': 1000, 'burst': 1000}
+                    env['HOST_LIMITS'] = json.dumps(
+                        {'youtube.com': unlimited, '127.0.0.1': unlimited})
+
+                cmd = [sys.executable, os.path.abspath(__file__), '--child',
+                       '--mode', options.mode, '--batch', str(batch),
+                       '--clients', str(clients), '--jobs', str(options.jobs),
+                       '--size-kb', str(options.size_kb), '--work-dir', work_dir]
+                if options.verbose:
+                    cmd.append('--verbose')
+                output = subprocess.run(cmd, env=env, capture_output=True, text=True,
+                                        cwd=os.path.dirname(os.path.abspath(__file__)))
+                if options.verbose:
+                    print(output.stdout + output.stderr)
+                if output.returncode != 0:
+                    print(f'batch={batch} clients={clients} failed:\n{output.stderr}')
+                    continue
+                result = json.loads((output.stdout or '').strip().splitlines()[-1])
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+            results.append(result)
+            print(f"{batch:>5} {clients:>7} {result['jobs_per_second']:>7.2f} "
+                  f"{result['links_per_second']:>8.2f} {result['p50_seconds']:>7.2f} "
+                  f"{result['p95_seconds']:>7.2f} {result['peak_rss_mb']:>7.1f} "
+                  f"{result['peak_tree_rss_mb']:>8.1f} {result['finished']:>4} "
+                  f"{result['failed']:>4} {result['rejected']:>5}")
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,9 @@ APP_DIR="/home/ec2-user/link-downloader"
 BRANCH="staging"
 SERVICE_NAME="link-downloader-staging"
 DOMAIN="staging.neillanda.com"
+APP_PORT="${APP_PORT:-5000}"
+DRAIN_TIMEOUT="${DRAIN_TIMEOUT:-300}"  # Seconds to wait for running downloads
+DRAIN_TOKEN="${DRAIN_TOKEN:-}"  # The service's DRAIN_TOKEN, if it sets one
 
 # Colors for output
 RED='\033[0;31m'
@@ -20,6 +23,35 @@ GREEN='\033[0;32m'
 YELLOW='\033[1;33m'
 NC='\033[0m' # No Color
 
+# Let in-flight downloads finish before restarting (see /drain in app.py).
+# Queued links are checkpointed in jobs.db and resumed by the new process.
+drain_service() {
+    local url="http://127.0.0.1:${APP_PORT}/drain"
+    local auth=()
+    local code
+    if [ -n "$DRAIN_TOKEN" ]; then
+        auth=(-H "X-Drain-Token: ${DRAIN_TOKEN}")
+    fi
+    code=$(curl -s -o /dev/null -w '%{http_code}' "${auth[@]}" -X POST -d mode=checkpoint "$url" || true)
+    if [ "$code" = "404" ]; then
+        # Restarting now would cut running downloads off without a checkpoint
+        echo "ERROR: /drain refused the request (HTTP 404). Export the service's DRAIN_TOKEN and rerun." >&2
+        exit 1
+    fi
+    if [ "$code" != "200" ] && [ "$code" != "202" ]; then
+        echo "Service not answering /drain (HTTP $code), restarting right away"
+        return
+    fi
+    for i in $(seq 1 "$DRAIN_TIMEOUT"); do
+        if [ "$(curl -s -o /dev/null -w '%{http_code}' "${auth[@]}" "$url")" = "200" ]; then
+            echo "Drained after ${i}s"
+            return
+        fi
+        sleep 1
+    done
+    echo "Still busy after ${DRAIN_TIMEOUT}s, restarting anyway (unfinished links resume after restart)"
+}
+
 # Check if we're in the right directory
 if [ ! -d "$APP_DIR" ]; then
     echo -e "${RED}Error: Directory $APP_DIR not found${NC}"
@@ -62,7 +94,11 @@ if [ ! -f "cookies.txt" ]; then
     echo -e "${YELLOW}Warning: cookies.txt not found. Some downloads may fail.${NC}"
 fi
 
-# Restart the service
+# Restart the service once running downloads are done
+if sudo systemctl is-active --quiet "$SERVICE_NAME"; then
+    echo -e "${YELLOW}Draining $SERVICE_NAME...${NC}"
+    drain_service
+fi
 echo -e "${YELLOW}Restarting $SERVICE_NAME service...${NC}"
 sudo systemctl restart "$SERVICE_NAME"
 
@@ -4,6 +4,39 @@
 
 echo "=== Link Downloader Deployment Script ==="
 
+APP_PORT=5000
+DRAIN_TIMEOUT="${DRAIN_TIMEOUT:-300}"  # Seconds to wait for running downloads
+DRAIN_TOKEN="${DRAIN_TOKEN:-}"  # The service's DRAIN_TOKEN, if it sets one
+
+# Let in-flight downloads finish before restarting (see /drain in app.py).
+# Queued links are checkpointed in jobs.db and resumed by the new process.
+drain_service() {
+    local url="http://127.0.0.1:${APP_PORT}/drain"
+    local auth=()
+    local code
+    if [ -n "$DRAIN_TOKEN" ]; then
+        auth=(-H "X-Drain-Token: ${DRAIN_TOKEN}")
+    fi
+    code=$(curl -s -o /dev/null -w '%{http_code}' "${auth[@]}" -X POST -d mode=checkpoint "$url" || true)
+    if [ "$code" = "404" ]; then
+        # Restarting now would cut running downloads off without a checkpoint
+        echo "ERROR: /drain refused the request (HTTP 404). Export the service's DRAIN_TOKEN and rerun." >&2
+        exit 1
+    fi
+    if [ "$code" != "200" ] && [ "$code" != "202" ]; then
+        echo "Service not answering /drain (HTTP $code), restarting right away"
+        return
+    fi
+    for i in $(seq 1 "$DRAIN_TIMEOUT"); do
+        if [ "$(curl -s -o /dev/null -w '%{http_code}' "${auth[@]}" "$url")" = "200" ]; then
+            echo "Drained after ${i}s"
+            return
+        fi
+        sleep 1
+    done
+    echo "Still busy after ${DRAIN_TIMEOUT}s, restarting anyway (unfinished links resume after restart)"
+}
+
 # Update system
 echo "Updating system..."
 sudo yum update -y
@@ -52,11 +85,17 @@ RestartSec=10
 WantedBy=multi-user.target
 EOF
 
-# Enable and start service
+# Enable and start service (re-deploys drain the running one first)
 echo "Starting Flask service..."
 sudo systemctl daemon-reload
 sudo systemctl enable link-downloader
-sudo systemctl start link-downloader
+if sudo systemctl is-active --quiet link-downloader; then
+    echo "Draining running service..."
+    drain_service
+    sudo systemctl restart link-downloader
+else
+    sudo systemctl start link-downloader
+fi
 
 # Configure Nginx
 echo "Configuring Nginx..."
@@ -119,6 +119,88 @@ if (downloadForm) {
     });
   }
 
+  // Titles and errors come from third-party sites, so escape them before using innerHTML
+  function escapeHtml(text) {
+    const div = document.createElement("div");
+    div.textContent = String(text ?? "");
+    return div.innerHTML;
+  }
+
+  // Follow a job's live progress over Server-Sent Events, resolving with the final job
+  function followJobEvents(jobId, submitBtn) {
+    return new Promise((resolve, reject) => {
+      const source = new EventSource(`/jobs/${jobId}/events`);
+      const links = {};
+
+      source.addEventListener("link", (event) => {
+        const link = JSON.parse(event.data);
+        links[link.index] = link;
+
+        // Playlists are counted through their entries
+        const all = Object.values(links).filter(
+          (l) => l.phase !== "expanding" && l.phase !== "expanded"
+        );
+        const doneCount = all.filter(
+          (l) => l.phase === "done" || l.phase === "failed"
+        ).length;
+        let text = `Downloading... ${doneCount}/${all.length}`;
+        const active = all.find((l) => l.phase === "downloading");
+        if (active && active.total_bytes) {
+          const percent = Math.floor(
+            (100 * active.downloaded_bytes) / active.total_bytes
+          );
+          text += ` (${percent}%)`;
+        } else if (all.some((l) => l.phase === "post-processing")) {
+          text += " (converting)";
+        }
+        submitBtn.textContent = text;
+      });
+
+      source.addEventListener("job", (event) => {
+        source.close();
+        resolve(JSON.parse(event.data));
+      });
+
+      source.onerror = () => {
+        source.close();
+        reject(new Error("Progress stream interrupted"));
+      };
+    });
+  }
+
+  // Poll a queued download job until it finishes or fails
+  async function waitForJob(jobId, submitBtn) {
+    if (window.EventSource) {
+      try {
+        return await followJobEvents(jobId, submitBtn);
+      } catch (streamError) {
+        console.error("Falling back to polling:", streamError);
+      }
+    }
+
+    while (true) {
+      const jobResponse = await fetch(`/jobs/${jobId}`);
+      if (!jobResponse.ok) {
+        throw new Error(`Lost track of download job (status ${jobResponse.status})`);
+      }
+      const job = await jobResponse.json();
+
+      if (job.status === "finished" || job.status === "failed") {
+        return job;
+      }
+
+      const items = job.links.filter(
+        (link) => link.status !== "expanding" && link.status !== "expanded"
+      );
+      const doneCount = items.filter(
+        (link) => link.status === "done" || link.status === "failed"
+      ).length;
+      submitBtn.textContent = `Downloading... ${doneCount}/${items.length}`;
+
+      await new Promise((resolve) => setTimeout(resolve, 2000));
+    }
+  }
+
   downloadForm.addEventListener("submit", async function (e) {
     e.preventDefault();
 
@@ -178,7 +260,7 @@ if (downloadForm) {
         // If no valid links, show error and stop
         if (!validationData.valid || validationData.valid.length === 0) {
           const invalidMessages = validationData.invalid.map(
-            (item) => `${item.title}: ${item.reason}`
+            (item) => `${escapeHtml(item.title)}: ${escapeHtml(item.reason)}`
           );
           errorDiv.innerHTML = `<strong>All links were rejected:</strong><br>${invalidMessages.join(
             "<br>"
@@ -202,7 +284,21 @@ if (downloadForm) {
       if (response.ok) {
         if (contentType.includes("application/json")) {
           // Handle JSON response with results
-          const data = await response.json();
+          let data = await response.json();
+
+          // The server queues the job and answers immediately - poll until it's done
+          if (data.job_id) {
+            data = await waitForJob(data.job_id, submitBtn);
+            if (data.status === "failed" && !data.has_file) {
+              errorDiv.textContent = `Error: ${
+                data.error || "No files were downloaded."
+              }`;
+              errorDiv.style.display = "block";
+              submitBtn.textContent = originalText;
+              submitBtn.disabled = false;
+              return;
+            }
+          }
 
           if (data.has_file && data.session_id) {
             // Download the file
@@ -226,14 +322,18 @@ if (downloadForm) {
           let resultsHTML = "";
 
           if (data.successful && data.successful.length > 0) {
-            const successfulTitles = data.successful.map((item) => item.title);
+            const successfulTitles = data.successful.map((item) =>
+              escapeHtml(item.title)
+            );
             resultsHTML += `<strong>Successfully downloaded:</strong><br>${successfulTitles.join(
               "<br>"
             )}`;
           }
 
           if (data.rejected && data.rejected.length > 0) {
-            const rejectedTitles = data.rejected.map((item) => item.title);
+            const rejectedTitles = data.rejected.map((item) =>
+              escapeHtml(item.title)
+            );
             resultsHTML += `<br><br><strong>Could not download:</strong><br>${rejectedTitles.join(
               "<br>"
             )}`;